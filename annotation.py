@@ -0,0 +1,149 @@
+import tempfile
+import threading
+import time
+import traceback
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Optional
+
+import fitz
+import numpy as np
+
+import document_loader
+from batch_io import LocalFileSystem
+from geometry import RectStore
+
+# color, line width
+BLOCK_STYLE = ((1, 0, 0), 0.5)
+TABLE_ROW_STYLE = ((0, 1, 0), 1)
+
+# full: the painted document is saved again as a whole (the old behaviour)
+# incremental: the original is copied and only the painted shapes are appended to the copy
+# overlay: a new pdf with the page sizes of the original that holds nothing but the boxes
+ANNOTATION_MODES = ('full', 'incremental', 'overlay')
+DEFAULT_ANNOTATION_MODE = 'full'
+
+# annotation tasks are small (box arrays only), the bound just keeps a stalled mount from piling them up
+ANNOTATION_QUEUE_SIZE = 256
+# processes that paint and write the annotated pdfs of a batch, see batch_io.IOConfig
+ANNOTATION_WORKERS = 2
+
+
+@dataclass
+class AnnotationBoxes:
+    # pages are 1-based like the span table
+    blocks: RectStore = field(default_factory=RectStore)
+    table_rows: RectStore = field(default_factory=RectStore)
+
+    @classmethod
+    def concat(cls, parts) -> "AnnotationBoxes":
+        parts = list(parts)
+        return cls(blocks=RectStore.concat([p.blocks for p in parts]),
+                   table_rows=RectStore.concat([p.table_rows for p in parts]))
+
+    def __len__(self) -> int:
+        return len(self.blocks) + len(self.table_rows)
+
+
+def paint_boxes(document: fitz.Document, boxes: AnnotationBoxes):
+    # one shape per page: every rect is drawn into it, one finish per style, one commit per page
+    styled = [(boxes.blocks, BLOCK_STYLE), (boxes.table_rows, TABLE_ROW_STYLE)]
+    pages = np.unique(np.concatenate([store.page for store, _ in styled]))
+    for page_num in pages.tolist():
+        shape = document[page_num - 1].new_shape()
+        for store, (color, width) in styled:
+            on_page = store[store.page == page_num]
+            if not len(on_page):
+                continue
+            for x0, y0, x1, y1 in zip(on_page.x0.tolist(), on_page.y0.tolist(), on_page.x1.tolist(),
+                                      on_page.y1.tolist()):
+                shape.draw_rect(fitz.Rect(x0, y0, x1, y1))
+            shape.finish(color=color, width=width, fill=None)
+        shape.commit()
+
+
+def annotated_bytes(source: bytes, boxes: AnnotationBoxes, mode: str = DEFAULT_ANNOTATION_MODE) -> bytes:
+    if mode not in ANNOTATION_MODES:
+        raise ValueError(f"unknown annotation mode {mode!r}, known: {', '.join(ANNOTATION_MODES)}")
+
+    if mode == 'overlay':
+        with document_loader.parse_document(source) as original, fitz.open() as overlay:
+            for page in original:
+                overlay.new_page(width=page.rect.width, height=page.rect.height)
+            paint_boxes(overlay, boxes)
+            return overlay.tobytes(garbage=3, deflate=True)
+
+    with document_loader.parse_document(source) as document:
+        if mode == 'incremental' and document.can_save_incrementally():
+            # mupdf only appends to a file, the copy is local and the pdf itself is not serialized again
+            with tempfile.TemporaryDirectory() as directory:
+                copy = Path(directory) / 'annotated.pdf'
+                copy.write_bytes(source)
+                with document_loader.parse_document(copy) as appended:
+                    paint_boxes(appended, boxes)
+                    appended.saveIncr()
+                return copy.read_bytes()
+        # encrypted or repaired files can not be appended to, they are written as a whole
+        paint_boxes(document, boxes)
+        return document.tobytes()
+
+
+def write_annotated(pdf_path: Path, output_path: Path, boxes: AnnotationBoxes,
+                    mode: str = DEFAULT_ANNOTATION_MODE, filesystem: Optional[LocalFileSystem] = None):
+    # the original is read and the painted pdf written through filesystem (the batch io of the run)
+    filesystem = filesystem or LocalFileSystem()
+    filesystem.write_bytes(output_path, annotated_bytes(filesystem.read_bytes(pdf_path), boxes, mode))
+
+
+@dataclass
+class AnnotationTask:
+    pdf_path: Path
+    output_path: Path
+    boxes: AnnotationBoxes
+    mode: str = DEFAULT_ANNOTATION_MODE
+
+
+def _write_task(task: AnnotationTask, filesystem: Optional[LocalFileSystem]) -> float:
+    start = time.perf_counter()
+    write_annotated(task.pdf_path, task.output_path, task.boxes, task.mode, filesystem)
+    return time.perf_counter() - start
+
+
+class AnnotationWriter:
+    # writes annotated pdfs on a few processes of their own (mupdf is not thread safe), the extraction only
+    # hands over the boxes. submit blocks while max_queued tasks are not written yet
+    def __init__(self, filesystem: Optional[LocalFileSystem] = None, workers: int = ANNOTATION_WORKERS,
+                 max_queued: int = ANNOTATION_QUEUE_SIZE):
+        self._filesystem = filesystem
+        self._slots = threading.BoundedSemaphore(max(max_queued, 1))
+        self._pool = ProcessPoolExecutor(max_workers=max(workers, 1))
+        self._lock = threading.Lock()
+        # pdf path -> traceback of the failed annotation
+        self.errors: Dict[Path, str] = {}
+        self.written = 0
+        self.seconds = 0.0
+
+    def submit(self, task: AnnotationTask):
+        self._slots.acquire()
+        try:
+            future = self._pool.submit(_write_task, task, self._filesystem)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda done: self._finished(task.pdf_path, done))
+
+    def _finished(self, pdf_path: Path, future: Future):
+        try:
+            seconds = future.result()
+            with self._lock:
+                self.written += 1
+                self.seconds += seconds
+        except Exception:
+            self.errors[pdf_path] = traceback.format_exc()
+        finally:
+            self._slots.release()
+
+    def close(self):
+        # waits for everything submitted so far
+        self._pool.shutdown(wait=True)
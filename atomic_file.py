@@ -0,0 +1,21 @@
+import os
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Iterator, Optional
+
+
+@contextmanager
+def atomic_write(path: Path, encoding: Optional[str] = None) -> Iterator[IO]:
+    # written to a temp file next to path and renamed over it once complete: readers (other workers, a
+    # textfile collector, the next run) see the old file or the new one, never half of it. a failed write
+    # leaves neither a changed path nor the temp file behind. binary, text with encoding
+    path = Path(path)
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w' if encoding else 'wb', encoding=encoding, newline='' if encoding else None) as f:
+            yield f
+        os.replace(tmp_name, path)
+    except BaseException:
+        Path(tmp_name).unlink(missing_ok=True)
+        raise
@@ -0,0 +1,685 @@
+import os
+import shutil
+import time
+import traceback
+from collections import Counter
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+from statistics import mean, stdev
+from typing import Callable, List, Optional, Iterable, Dict
+
+import document_loader
+from batch_io import IOConfig, LocalFileSystem, Prefetcher, WriteBehind
+from manifest import Manifest
+from annotation import AnnotationBoxes, AnnotationTask, AnnotationWriter, ANNOTATION_WORKERS, DEFAULT_ANNOTATION_MODE
+from metrics import DocumentMetrics, MetricsAggregate, append_json_records
+from stage_cache import StageCache, hash_bytes, hash_file
+from table_render import DEFAULT_TABLE_FORMAT
+from shard_output import DEFAULT_OUTPUT_FORMAT, OUTPUT_FORMATS, SHARD_DIR_NAME, ShardWriter
+
+# recycle a worker after this many documents, PyMuPDF does not give back all memory it allocates
+MAX_DOCUMENTS_PER_WORKER = 25
+# planning stats and opens every pdf, all of it waits on the disk / mount
+PLAN_THREADS = 8
+# joins the directories of a pdf into its output name, see output_name_for
+OUTPUT_NAME_SEPARATOR = '__'
+# run_batch with micro_batch > 1 sends documents up to this many pages to a worker in groups
+MICRO_BATCH_MAX_PAGES = 3
+
+
+@dataclass
+class ExtractionJob:
+    pdf_path: Path
+    output_dir: Path
+    # name of the output files in output_dir, None: the pdf name up to its first dot, see output_name_for
+    output_name: Optional[str] = None
+    page_count: int = 0
+    file_size: int = 0
+    annotate: bool = False
+    annotated_output_dir: Optional[Path] = None
+    # see annotation.ANNOTATION_MODES
+    annotation_mode: str = DEFAULT_ANNOTATION_MODE
+    # processes used to scan the pages of one large document
+    page_workers: int = 1
+    content_hash: Optional[str] = None
+    # hash the content (if not known) to find copies of the same pdf, see run_batch
+    deduplicate: bool = False
+    cache_dir: Optional[Path] = None
+    # process and write page by page, bounds the memory of very large documents
+    stream: bool = False
+    collect_metrics: bool = False
+    # tracemalloc is expensive, only trace python allocations when asked for
+    track_memory: bool = False
+    # renderer for detected tables, see table_render.TABLE_RENDERERS
+    table_format: str = DEFAULT_TABLE_FORMAT
+    # see shard_output.OUTPUT_FORMATS, the shard formats hand the block records to the shard writer of the batch
+    output_format: str = DEFAULT_OUTPUT_FORMAT
+    # set by run_batch when it runs with an IOConfig: the pdf read ahead by the batch (None: read it from
+    # filesystem), and whether the output text goes back to the batch for its write-behind pool
+    pdf_bytes: Optional[bytes] = None
+    filesystem: Optional[LocalFileSystem] = None
+    write_behind: bool = False
+
+    @property
+    def name(self) -> str:
+        return self.output_name or self.pdf_path.name.split(".")[0]
+
+    @property
+    def output_file(self) -> Path:
+        # where dump_blocks_to_file writes the blocks of this job
+        return self.output_dir / f"{self.name}.txt"
+
+    @property
+    def document_id(self) -> str:
+        # key of the document in the shard index
+        return str(self.pdf_path)
+
+    @property
+    def sharded(self) -> bool:
+        return self.output_format != 'text'
+
+    @property
+    def annotated_file(self) -> Optional[Path]:
+        if not self.annotate:
+            return None
+        return self.annotated_output_dir / (f"{self.output_name}.pdf" if self.output_name else self.pdf_path.name)
+
+
+@dataclass
+class ExtractionResult:
+    pdf_path: Path
+    page_count: int = 0
+    file_size: int = 0
+    elapsed: Optional[float] = None
+    error: Optional[str] = None
+    crashed: bool = False
+    # set if the pdf has the same content as an already extracted one, its output was copied
+    duplicate_of: Optional[Path] = None
+    # hash of the pdf if the worker computed it (the job did not know it)
+    content_hash: Optional[str] = None
+    # DocumentMetrics.to_dict() of the extraction
+    metrics: Optional[dict] = None
+    # boxes to paint, handed from the worker to the annotation writer of the batch
+    annotation: Optional[AnnotationBoxes] = None
+    # the annotated pdf is optional, failing to write it does not fail the extraction
+    annotation_error: Optional[str] = None
+    # output of a write_behind job, written by the batch
+    output_text: Optional[str] = None
+    # block records of a sharded job (shard_output.BLOCK_RECORD_DTYPES), appended to a shard by the batch
+    output_records: Optional[Dict] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+@dataclass
+class BatchReport:
+    results: List[ExtractionResult] = field(default_factory=list)
+    wall_time: float = 0.0
+
+    @property
+    def succeeded(self) -> List[ExtractionResult]:
+        return [r for r in self.results if r.ok]
+
+    @property
+    def failed(self) -> List[ExtractionResult]:
+        return [r for r in self.results if not r.ok]
+
+    @property
+    def annotation_failed(self) -> List[ExtractionResult]:
+        return [r for r in self.results if r.annotation_error is not None]
+
+    @property
+    def exec_times(self) -> List[float]:
+        return [r.elapsed for r in self.succeeded if r.elapsed is not None]
+
+    def aggregate_metrics(self) -> MetricsAggregate:
+        aggregate = MetricsAggregate()
+        for result in self.results:
+            if result.duplicate_of is None:
+                aggregate.add(result.metrics, failed=not result.ok)
+        return aggregate
+
+    def write_metrics(self, json_path: Optional[Path] = None, prometheus_path: Optional[Path] = None):
+        if json_path is not None:
+            append_json_records(json_path, [
+                {**r.metrics, 'elapsed': r.elapsed, 'ok': r.ok} for r in self.results if r.metrics is not None
+            ])
+        if prometheus_path is not None:
+            self.aggregate_metrics().write_prometheus(prometheus_path)
+
+    def slowest(self, n: int = 10) -> List[ExtractionResult]:
+        return sorted(self.succeeded, key=lambda r: r.elapsed or 0.0, reverse=True)[:n]
+
+    def summary(self) -> str:
+        times = self.exec_times
+        if not times:
+            return f"No file extracted ({len(self.failed)} failed) in {self.wall_time:.2f}s"
+        m = mean(times)
+        s = stdev(times) if len(times) > 1 else 0.0
+        summary = (
+            f"Mean execution time: {m:.4f}s | Std: {s:.4f}s over {len(times)} file(s) | "
+            f"sum: {sum(times):.2f}s | wall: {self.wall_time:.2f}s | failed: {len(self.failed)}"
+        )
+        # only known if the jobs collected metrics
+        counts = self.aggregate_metrics().counts
+        if counts.get('pages'):
+            skipped = counts.get('pages_drawings_skipped', 0)
+            summary += f" | drawings skipped: {skipped}/{counts['pages']} pages ({skipped / counts['pages']:.0%})"
+        if self.annotation_failed:
+            summary += f" | annotation failed: {len(self.annotation_failed)}"
+        return summary
+
+
+def output_name_for(pdf_path: Path, source_root: Path) -> str:
+    # the path below source_root, pdfs of different directories share one flat output directory and may
+    # have the same name: a/with_pid_case/x.pdf -> a__with_pid_case__x
+    relative = Path(pdf_path).relative_to(source_root).with_suffix('')
+    return OUTPUT_NAME_SEPARATOR.join(relative.parts)
+
+
+def plan_jobs(pdf_paths: Iterable[Path], output_dir: Path, annotate: bool = False, page_workers: int = 1,
+              deduplicate: bool = True, cache_dir: Optional[Path] = None,
+              stream_min_pages: Optional[int] = None, collect_metrics: bool = False,
+              track_memory: bool = False, table_format: str = DEFAULT_TABLE_FORMAT,
+              annotation_mode: str = DEFAULT_ANNOTATION_MODE,
+              content_hashes: Optional[Dict[Path, str]] = None,
+              output_format: str = DEFAULT_OUTPUT_FORMAT,
+              source_root: Optional[Path] = None) -> List[ExtractionJob]:
+    # content_hashes: hashes that are already known (e.g. Manifest.content_hashes). nothing is hashed here,
+    # the workers hash what they read anyway and run_batch only hashes files that may be copies.
+    # source_root: the outputs are named after the path below it (output_name_for), without it after the pdf
+    # name only. two pdfs that would write the same output file are refused
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"unknown output format {output_format!r}, known: {', '.join(OUTPUT_FORMATS)}")
+    jobs = [
+        ExtractionJob(
+            pdf_path=pdf_path,
+            output_dir=output_dir,
+            output_name=output_name_for(pdf_path, source_root) if source_root is not None else None,
+            annotate=annotate,
+            annotated_output_dir=output_dir if annotate else None,
+            annotation_mode=annotation_mode,
+            page_workers=page_workers,
+            content_hash=content_hashes.get(pdf_path) if content_hashes else None,
+            deduplicate=deduplicate,
+            cache_dir=cache_dir,
+            collect_metrics=collect_metrics,
+            track_memory=track_memory,
+            table_format=table_format,
+            output_format=output_format,
+        )
+        for pdf_path in pdf_paths
+    ]
+    if output_format == 'text':
+        writers = Counter(job.output_file for job in jobs)
+        clashes = sorted(str(job.pdf_path) for job in jobs if writers[job.output_file] > 1)
+        if clashes:
+            raise ValueError(f"pdfs with the same output file: {', '.join(clashes)}")
+
+    def read_file_info(job: ExtractionJob):
+        job.file_size = job.pdf_path.stat().st_size
+
+    # stat only waits on the disk, run them side by side. fitz is not thread safe, the documents are opened
+    # one after the other below
+    with ThreadPoolExecutor(max_workers=PLAN_THREADS) as pool:
+        infos = [pool.submit(read_file_info, job) for job in jobs]
+
+    for job, info in zip(jobs, infos):
+        try:
+            info.result()
+            # opening only reads the xref, page content is not parsed here
+            with document_loader.parse_document(job.pdf_path) as document:
+                job.page_count = document.page_count
+            job.stream = stream_min_pages is not None and job.page_count >= stream_min_pages
+        except Exception:
+            # broken files are still scheduled so the failure ends up in the report
+            pass
+
+    # longest processing time first: big documents start early so they do not end up as the tail
+    jobs.sort(key=lambda j: (j.page_count, j.file_size), reverse=True)
+    return jobs
+
+
+# one cache object per worker process and directory
+_stage_caches: Dict[Path, StageCache] = {}
+
+
+def _stage_cache(cache_dir: Path) -> StageCache:
+    if cache_dir not in _stage_caches:
+        _stage_caches[cache_dir] = StageCache(cache_dir)
+    return _stage_caches[cache_dir]
+
+
+def _read_source(job: ExtractionJob) -> Optional[bytes]:
+    if job.pdf_bytes is None and job.filesystem is not None:
+        return job.filesystem.read_bytes(job.pdf_path)
+    return job.pdf_bytes
+
+
+def _wrap_document(job: ExtractionJob, document, source: Optional[bytes]):
+    # imported here so the parent process does not need to load pandas to schedule work
+    from mu_document_utils import DocumentWrapper
+
+    return DocumentWrapper.from_document(
+        document,
+        page_workers=job.page_workers,
+        source_bytes=source,
+        cache=_stage_cache(job.cache_dir) if job.cache_dir is not None else None,
+        content_hash=job.content_hash,
+        metrics=DocumentMetrics(str(job.pdf_path), track_memory=job.track_memory)
+        if job.collect_metrics else None,
+        table_format=job.table_format,
+    )
+
+
+def _with_content_hash(job: ExtractionJob, source: Optional[bytes]) -> ExtractionJob:
+    # the hash keys the stage cache and finds copies of the pdf, taken from the bytes the worker reads anyway
+    if job.content_hash is not None or not (job.deduplicate or job.cache_dir is not None):
+        return job
+    return replace(job, content_hash=hash_bytes(source) if source is not None else hash_file(job.pdf_path))
+
+
+def _write_blocks(job: ExtractionJob, result: ExtractionResult, doc):
+    # the output of a processed document: block records for the shard writer, the tsv file or its text
+    if job.sharded:
+        result.output_records = doc.block_records()
+    elif job.filesystem is None:
+        doc.dump_blocks_to_file(job.output_dir, job.name)
+    else:
+        _write_output(job, result, doc.blocks_text())
+
+
+def extract_document(job: ExtractionJob) -> ExtractionResult:
+    from mu_document_utils import process_documents
+    result = ExtractionResult(pdf_path=job.pdf_path, page_count=job.page_count, file_size=job.file_size)
+    doc = None
+    try:
+        source = _read_source(job)
+        job = _with_content_hash(job, source)
+        result.content_hash = job.content_hash
+        with document_loader.parse_document(job.pdf_path if source is None else source) as document:
+            doc = _wrap_document(job, document, source)
+            start_time = time.time()
+            if job.stream and job.sharded:
+                result.output_records, result.annotation = doc.stream_block_records(collect_boxes=job.annotate)
+                result.elapsed = time.time() - start_time
+                return result
+            if job.stream:
+                if job.filesystem is None:
+                    result.annotation = doc.stream_blocks_to_file(job.output_dir, job.name,
+                                                                  collect_boxes=job.annotate)
+                else:
+                    # written from here page by page, also with write_behind: the text of a document large
+                    # enough to stream is never held in memory or sent back to the batch
+                    with job.filesystem.open_write(job.output_file, encoding='utf-8') as f:
+                        result.annotation = doc.stream_blocks(f, collect_boxes=job.annotate)
+                result.elapsed = time.time() - start_time
+                return result
+
+            # a batch of one: a document without tables never builds its frames (and never imports pandas)
+            process_documents([doc])
+            _write_blocks(job, result, doc)
+            result.elapsed = time.time() - start_time
+
+            # optional for debugging detected stuff, painted and written by the annotation writer of the batch
+            if job.annotate:
+                result.annotation = doc.annotation_boxes()
+    except Exception:
+        result.elapsed = None
+        result.error = traceback.format_exc()
+    finally:
+        if doc is not None and doc.metrics is not None:
+            result.metrics = doc.metrics.to_dict()
+    return result
+
+
+def extract_documents(jobs: List[ExtractionJob]) -> List[ExtractionResult]:
+    # a micro batch of small documents: the frame stages run once over the spans of all of them
+    # (mu_document_utils.process_documents), the outputs are the same as from extract_document.
+    # if anything fails every document is extracted again on its own, the error ends up at its document
+    from mu_document_utils import process_documents
+
+    if any(job.stream for job in jobs):
+        return [extract_document(job) for job in jobs]
+    results = [ExtractionResult(pdf_path=job.pdf_path, page_count=job.page_count, file_size=job.file_size)
+               for job in jobs]
+    # the jobs get their content hash below
+    jobs = list(jobs)
+    try:
+        with ExitStack() as stack:
+            docs = []
+            for i, job in enumerate(jobs):
+                source = _read_source(job)
+                job = jobs[i] = _with_content_hash(job, source)
+                results[i].content_hash = job.content_hash
+                document = stack.enter_context(
+                    document_loader.parse_document(job.pdf_path if source is None else source))
+                docs.append(_wrap_document(job, document, source))
+            start_time = time.time()
+            process_documents(docs)
+            # the shared stages are not timed per document, every document gets an equal share
+            shared = (time.time() - start_time) / len(jobs)
+            for job, result, doc in zip(jobs, results, docs):
+                start_time = time.time()
+                _write_blocks(job, result, doc)
+                result.elapsed = shared + time.time() - start_time
+                if job.annotate:
+                    result.annotation = doc.annotation_boxes()
+                if doc.metrics is not None:
+                    result.metrics = doc.metrics.to_dict()
+    except Exception:
+        return [extract_document(job) for job in jobs]
+    return results
+
+
+def _write_output(job: ExtractionJob, result: ExtractionResult, text: str):
+    if job.write_behind:
+        result.output_text = text
+    else:
+        job.filesystem.write_bytes(job.output_file, text.encode('utf-8'))
+
+
+def _duplicate_result(primary: ExtractionJob, primary_result: ExtractionResult, duplicate: ExtractionJob,
+                      primary_text: Optional[str] = None, primary_records: Optional[Dict] = None) -> ExtractionResult:
+    result = ExtractionResult(
+        pdf_path=duplicate.pdf_path,
+        page_count=duplicate.page_count,
+        file_size=duplicate.file_size,
+        error=primary_result.error,
+        crashed=primary_result.crashed,
+        duplicate_of=primary.pdf_path,
+        content_hash=primary.content_hash,
+    )
+    if not primary_result.ok:
+        return result
+    # same content, same boxes: the writer paints the duplicate from the boxes of the primary
+    result.annotation = primary_result.annotation if duplicate.annotate else None
+    if primary_records is not None:
+        # every document has its own entry in the shard index, the records are appended again
+        result.output_records = primary_records
+        return result
+    if primary_text is not None:
+        # the output of the primary may still wait in the write-behind pool, write the text again
+        result.output_text = primary_text
+        return result
+    try:
+        shutil.copyfile(primary.output_file, duplicate.output_file)
+    except OSError:
+        result.error = traceback.format_exc()
+    return result
+
+
+def _crashed_result(job: ExtractionJob) -> ExtractionResult:
+    return ExtractionResult(
+        pdf_path=job.pdf_path,
+        page_count=job.page_count,
+        file_size=job.file_size,
+        error="worker process died while extracting this document",
+        crashed=True,
+    )
+
+
+@dataclass
+class WorkerSlot:
+    # one single-process executor per slot: a crash can be traced to exactly one document and the
+    # process can be replaced after a fixed number of documents (max_tasks_per_child hangs on 3.13.0)
+    # initializer runs once in every new process (e.g. to import and warm up the extraction)
+    initializer: Optional[Callable[[], None]] = None
+    executor: Optional[ProcessPoolExecutor] = None
+    processed: int = 0
+
+    def __post_init__(self):
+        if self.executor is None:
+            self.executor = self._new_executor()
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=1, initializer=self.initializer)
+
+    def recycle(self):
+        self.executor.shutdown(wait=True)
+        self.executor = self._new_executor()
+        self.processed = 0
+
+    def kill(self):
+        # for a document that ran over its time limit: the process is stopped instead of waited for.
+        # the executor has no public way to reach its process (terminate_workers is 3.14+)
+        processes = list((getattr(self.executor, '_processes', None) or {}).values())
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()
+        self.executor = self._new_executor()
+        self.processed = 0
+
+
+def run_batch(
+        jobs: List[ExtractionJob],
+        max_workers: Optional[int] = None,
+        max_documents_per_worker: int = MAX_DOCUMENTS_PER_WORKER,
+        verbose: bool = True,
+        io_config: Optional[IOConfig] = None,
+        manifest: Optional[Manifest] = None,
+        micro_batch: int = 1,
+) -> BatchReport:
+    # with io_config all pdf reads and output writes go through its filesystem: pdfs are read ahead into
+    # memory and sent to the workers, the outputs come back as text and are written behind. streamed
+    # documents are the exception, their worker writes the pages through the filesystem as they are done.
+    # with a manifest every document is marked running when it is submitted and recorded when it comes
+    # back, a document only counts as done once its output is written (for shards: once its shard is sealed).
+    # micro_batch > 1: small documents (MICRO_BATCH_MAX_PAGES) go to a worker up to that many at a time and share
+    # the frame stages (extract_documents), a micro batch that crashes its worker runs again one by one.
+    # deduplicating jobs: only files of the same size can be copies of each other, those are hashed when they
+    # are taken from the queue (from the read-ahead bytes if there are any). the first job of a content is
+    # extracted, the later ones reuse its result. all other files are hashed by their worker
+    report = BatchReport()
+    start_time = time.time()
+    # annotated pdfs are painted and written by processes of their own, the workers only extract
+    writer = None
+    if any(job.annotate for job in jobs):
+        writer = AnnotationWriter(io_config.filesystem, io_config.annotation_workers or ANNOTATION_WORKERS) \
+            if io_config is not None else AnnotationWriter()
+    annotated_files = {job.pdf_path: job.annotated_file for job in jobs}
+    annotation_modes = {job.pdf_path: job.annotation_mode for job in jobs}
+    output_files = {job.pdf_path: job.output_file for job in jobs}
+    content_hashes = {job.pdf_path: job.content_hash for job in jobs}
+    pdf_paths = {job.output_file: job.pdf_path for job in jobs if not job.sharded}
+    # sharded jobs: one writer per shard directory and format, shared by all documents of the batch
+    shard_keys = {job.pdf_path: (job.output_dir / SHARD_DIR_NAME, job.output_format) for job in jobs if job.sharded}
+    document_ids = {job.document_id: job.pdf_path for job in jobs}
+    shard_writers: Dict[tuple, ShardWriter] = {}
+    for pdf_path, (shard_dir, _) in shard_keys.items():
+        output_files[pdf_path] = shard_dir
+    # file size -> deduplicating jobs of that size, and how many of them are still in the queue
+    sizes = Counter(job.file_size for job in jobs if job.deduplicate)
+    same_size = sizes.copy()
+    # content hash -> the job extracted for it, the jobs waiting for its result and, once it is done, its
+    # result (only kept while the queue still has files of its size)
+    primaries: Dict[str, ExtractionJob] = {}
+    duplicates: Dict[str, List[ExtractionJob]] = {}
+    finished: Dict[str, tuple] = {}
+    # jobs are expected in plan_jobs order, the next free worker always takes the largest remaining one
+    queue = list(reversed(jobs))
+    # (job, task) of crashed micro batches, each runs alone to find the document that crashed
+    retry = []
+    slots = [WorkerSlot() for _ in range(min(max_workers or os.cpu_count(), max(len(jobs), 1)))]
+    running = {}
+
+    prefetcher = None
+    write_behind = None
+    if io_config is not None and io_config.read_ahead > 0:
+        # reads in the order the jobs are taken from the queue
+        prefetcher = Prefetcher([job.pdf_path for job in jobs], io_config.filesystem, io_config.read_ahead,
+                                io_config.read_threads)
+    if io_config is not None and io_config.write_behind > 0:
+        write_behind = WriteBehind(io_config.filesystem, io_config.write_behind, io_config.write_threads)
+
+    def collect(result: ExtractionResult):
+        report.results.append(result)
+        if manifest is not None:
+            manifest.record(result, result.content_hash or content_hashes[result.pdf_path],
+                            output_files[result.pdf_path],
+                            annotated_files[result.pdf_path],
+                            output_written=result.output_text is None and result.output_records is None)
+        if result.output_text is not None:
+            write_behind.submit(output_files[result.pdf_path], result.output_text.encode('utf-8'))
+            result.output_text = None
+        if result.output_records is not None:
+            key = shard_keys[result.pdf_path]
+            if key not in shard_writers:
+                shard_writers[key] = ShardWriter(*key)
+            shard_writers[key].append(str(result.pdf_path), result.output_records)
+            result.output_records = None
+        if result.annotation is not None:
+            writer.submit(AnnotationTask(result.pdf_path, annotated_files[result.pdf_path], result.annotation,
+                                         annotation_modes[result.pdf_path]))
+        if verbose:
+            print(result.elapsed if result.ok else f"failed: {result.pdf_path}")
+
+    def mark_written():
+        if manifest is None:
+            return
+        if write_behind is not None:
+            while not write_behind.written.empty():
+                manifest.mark_written(pdf_paths[write_behind.written.get()])
+        for shard_writer in shard_writers.values():
+            for document in shard_writer.take_sealed():
+                manifest.mark_written(document_ids[document])
+
+    def batchable(job: ExtractionJob) -> bool:
+        return not job.stream and job.page_count <= MICRO_BATCH_MAX_PAGES
+
+    def task_for(job: ExtractionJob) -> ExtractionJob:
+        if io_config is None:
+            return job
+        pdf_bytes = prefetcher.take()[1] if prefetcher is not None else None
+        return replace(job, pdf_bytes=pdf_bytes, filesystem=io_config.filesystem,
+                       write_behind=write_behind is not None)
+
+    def take(batchable_only: bool = False):
+        # the next (job, task) of the queue, copies of an already taken content are set aside on the way
+        while queue and (not batchable_only or batchable(queue[-1])):
+            job = queue.pop()
+            task = task_for(job)
+            if not job.deduplicate:
+                return job, task
+            same_size[job.file_size] -= 1
+            if job.content_hash is None:
+                if sizes[job.file_size] < 2:
+                    # no other file of this size, it can not be a copy
+                    return job, task
+                try:
+                    job.content_hash = hash_bytes(task.pdf_bytes) if task.pdf_bytes is not None \
+                        else hash_file(job.pdf_path)
+                except OSError:
+                    # the worker fails on it and reports the error
+                    return job, task
+                content_hashes[job.pdf_path] = job.content_hash
+                task = replace(task, content_hash=job.content_hash)
+            copy_of = finished.get(job.content_hash)
+            if not same_size[job.file_size]:
+                # the last file of its size, no later job needs the finished results of this size
+                for content_hash in [h for h, done in finished.items() if done[0].file_size == job.file_size]:
+                    del finished[content_hash]
+            if copy_of is not None:
+                primary, primary_result, primary_text, primary_records = copy_of
+                collect(_duplicate_result(primary, primary_result, job, primary_text, primary_records))
+            elif job.content_hash in primaries:
+                duplicates[job.content_hash].append(job)
+            else:
+                primaries[job.content_hash] = job
+                duplicates[job.content_hash] = []
+                return job, task
+        return None
+
+    def submit(slot: WorkerSlot):
+        if retry:
+            group = [retry.pop()]
+        else:
+            first = take()
+            if first is None:
+                return
+            group = [first]
+            while len(group) < micro_batch and batchable(first[0]):
+                item = take(batchable_only=True)
+                if item is None:
+                    break
+                group.append(item)
+        if manifest is not None:
+            for job, _ in group:
+                manifest.mark_running(job.pdf_path)
+        if len(group) == 1:
+            future = slot.executor.submit(extract_document, group[0][1])
+            # the bytes only travel with the task, the batch keeps the job without them
+            group = [(group[0][0], None)]
+        else:
+            # a micro batch keeps its tasks until it is done, it may have to run them again
+            future = slot.executor.submit(extract_documents, [task for _, task in group])
+        running[future] = (slot, group)
+
+    try:
+        for slot in slots:
+            submit(slot)
+
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                slot, group = running.pop(future)
+                try:
+                    results = future.result()
+                    if len(group) == 1:
+                        results = [results]
+                    slot.processed += len(group)
+                    if slot.processed >= max_documents_per_worker:
+                        slot.recycle()
+                except BrokenProcessPool:
+                    slot.recycle()
+                    if len(group) > 1:
+                        retry.extend(reversed(group))
+                        submit(slot)
+                        continue
+                    results = [_crashed_result(group[0][0])]
+
+                for (job, _), result in zip(group, results):
+                    primary_text, primary_records = result.output_text, result.output_records
+                    collect(result)
+                    if primaries.get(job.content_hash) is not job:
+                        continue
+                    for duplicate in duplicates.pop(job.content_hash):
+                        collect(_duplicate_result(job, result, duplicate, primary_text, primary_records))
+                    if same_size[job.file_size]:
+                        finished[job.content_hash] = (job, result, primary_text, primary_records)
+                submit(slot)
+            mark_written()
+    finally:
+        for slot in slots:
+            slot.executor.shutdown(wait=False, cancel_futures=True)
+        if prefetcher is not None:
+            prefetcher.close()
+        if write_behind is not None:
+            write_behind.close()
+        if writer is not None:
+            writer.close()
+        for shard_writer in shard_writers.values():
+            shard_writer.close()
+
+    if write_behind is not None:
+        for result in report.results:
+            write_error = write_behind.errors.get(output_files[result.pdf_path])
+            if write_error is not None and result.ok:
+                result.error = f"writing the output failed\n{write_error}"
+                if manifest is not None:
+                    manifest.set_error(result.pdf_path, result.error)
+    mark_written()
+
+    if writer is not None:
+        for result in report.results:
+            # the boxes are written out, do not keep them alive in the report
+            result.annotation = None
+            result.annotation_error = writer.errors.get(result.pdf_path)
+    report.wall_time = time.time() - start_time
+    return report
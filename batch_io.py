@@ -0,0 +1,132 @@
+import queue
+import threading
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import IO, ContextManager, Deque, Dict, Iterable, Iterator, Optional, Tuple
+
+from atomic_file import atomic_write
+
+
+class LocalFileSystem:
+    # all reads and writes of the batch io go through this, tests swap in SlowFileSystem
+    def read_bytes(self, path: Path) -> bytes:
+        return Path(path).read_bytes()
+
+    def write_bytes(self, path: Path, data: bytes):
+        # a crashed run never leaves half an output that looks done
+        with atomic_write(path) as f:
+            f.write(data)
+
+    def open_write(self, path: Path, encoding: Optional[str] = None) -> ContextManager[IO]:
+        # for outputs written piece by piece (streamed documents), only in place once complete
+        return atomic_write(path, encoding)
+
+
+@dataclass
+class SlowFileSystem(LocalFileSystem):
+    # stand-in for the network mount: every call waits latency + size / bandwidth before it completes
+    latency: float = 0.05
+    bytes_per_second: Optional[float] = None
+
+    def _wait(self, size: int):
+        time.sleep(self.latency + (size / self.bytes_per_second if self.bytes_per_second else 0.0))
+
+    def read_bytes(self, path: Path) -> bytes:
+        data = super().read_bytes(path)
+        self._wait(len(data))
+        return data
+
+    def write_bytes(self, path: Path, data: bytes):
+        self._wait(len(data))
+        super().write_bytes(path, data)
+
+    @contextmanager
+    def open_write(self, path: Path, encoding: Optional[str] = None) -> Iterator[IO]:
+        with super().open_write(path, encoding) as f:
+            yield f
+            size = f.tell()
+        self._wait(size)
+
+
+@dataclass
+class IOConfig:
+    filesystem: LocalFileSystem = field(default_factory=LocalFileSystem)
+    # pdfs read into memory ahead of the worker that needs them, 0 lets every worker read its own pdf
+    read_ahead: int = 8
+    read_threads: int = 4
+    # outputs handed to the writer pool that are not written yet, a full pool blocks the batch loop.
+    # 0 lets every worker write its own output
+    write_behind: int = 32
+    write_threads: int = 4
+    # processes that write the annotated pdfs, None: annotation.ANNOTATION_WORKERS
+    annotation_workers: Optional[int] = None
+
+
+class Prefetcher:
+    # reads the pdfs in the order they are taken, at most `depth` of them are in flight or waiting
+    # in memory, a slow consumer stops the reads (back-pressure) instead of filling up the memory
+    def __init__(self, paths: Iterable[Path], filesystem: LocalFileSystem, depth: int, threads: int = 4):
+        self._paths = iter(paths)
+        self._filesystem = filesystem
+        self._depth = max(depth, 1)
+        self._pool = ThreadPoolExecutor(max_workers=max(threads, 1), thread_name_prefix="prefetch")
+        self._pending: Deque = deque()
+        self._fill()
+
+    def _fill(self):
+        while len(self._pending) < self._depth:
+            path = next(self._paths, None)
+            if path is None:
+                return
+            self._pending.append((path, self._pool.submit(self._filesystem.read_bytes, path)))
+
+    def take(self) -> Tuple[Path, Optional[bytes]]:
+        # None if the read failed, the worker then opens the path itself and reports the real error
+        path, future = self._pending.popleft()
+        # the next read starts before waiting on this one
+        self._fill()
+        try:
+            return path, future.result()
+        except OSError:
+            return path, None
+
+    def close(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+
+class WriteBehind:
+    # writes outputs on a thread pool, submit blocks while `depth` writes are still pending
+    def __init__(self, filesystem: LocalFileSystem, depth: int, threads: int = 4):
+        self._filesystem = filesystem
+        self._slots = threading.BoundedSemaphore(max(depth, 1))
+        self._pool = ThreadPoolExecutor(max_workers=max(threads, 1), thread_name_prefix="write-behind")
+        # output path -> traceback of the failed write
+        self.errors: Dict[Path, str] = {}
+        # output paths that are on the filesystem, in the order the writes finished
+        self.written: "queue.SimpleQueue[Path]" = queue.SimpleQueue()
+
+    def submit(self, path: Path, data: bytes):
+        self._slots.acquire()
+        try:
+            self._pool.submit(self._write, path, data)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def _write(self, path: Path, data: bytes):
+        try:
+            self._filesystem.write_bytes(path, data)
+            self.written.put(path)
+        except Exception:
+            self.errors[path] = traceback.format_exc()
+        finally:
+            self._slots.release()
+
+    def close(self):
+        # waits for everything submitted so far
+        self._pool.shutdown(wait=True)
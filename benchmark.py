@@ -0,0 +1,291 @@
+import argparse
+import json
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import time
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import List, Dict, Optional
+
+import fitz
+
+BENCHMARK_FORMAT_VERSION = 1
+
+WORDS = ["Befund", "Patient", "Untersuchung", "normal", "mg/dl", "Leukozyten", "negativ", "Kontrolle", "12.5",
+         "Diagnose", "unauffällig", "Labor", "Wert", "Referenz", "<", "0.3", "Datum", "Station"]
+FONTS = ["helv", "hebo", "tiro", "tibo", "cour"]
+
+# regressions smaller than this factor are treated as noise
+DEFAULT_REGRESSION_THRESHOLD = 1.15
+
+# what a run imports before it touches a document. fitz and numpy take about 0.5s of it, pandas alone would
+# add about 0.75s: pandas (tables, validation) and pydantic (MyRect) are imported where they are used
+IMPORT_MODULES = ['mu_document_utils', 'batch_extraction']
+IMPORT_TIME_BUDGET = 1.2
+FORBIDDEN_IMPORTS = ['pandas', 'pydantic', 'traits', 'pyarrow']
+
+
+@dataclass
+class CorpusSpec:
+    name: str
+    pages: int
+    lines_per_page: int
+    spans_per_line: int
+    fonts: int
+    table_rows_per_page: int
+    table_columns: int = 4
+    seed: int = 0
+
+
+# small reports dominate the real corpus, the long ones dominate the tail
+DEFAULT_CORPUS = [
+    CorpusSpec("short_text", pages=1, lines_per_page=35, spans_per_line=2, fonts=2, table_rows_per_page=0, seed=1),
+    CorpusSpec("short_table", pages=2, lines_per_page=20, spans_per_line=2, fonts=3, table_rows_per_page=12, seed=2),
+    CorpusSpec("dense_text", pages=10, lines_per_page=70, spans_per_line=5, fonts=5, table_rows_per_page=0, seed=3),
+    CorpusSpec("table_heavy", pages=10, lines_per_page=10, spans_per_line=2, fonts=2, table_rows_per_page=30,
+               table_columns=6, seed=4),
+    CorpusSpec("long_mixed", pages=120, lines_per_page=40, spans_per_line=3, fonts=4, table_rows_per_page=8, seed=5),
+]
+
+STAGES = [
+    'scan_pages',
+    'has_table',
+    'parse_pdf_entries',
+    'sanitize_parsed_pdf_entries',
+    'apply_table_boundaries',
+    'collapse_parsed_entries_into_rows',
+    'detect_connected_blocks_from_rows',
+    'dump_blocks_to_file',
+    'process_documents',
+]
+
+
+def generate_pdf(spec: CorpusSpec, path: Path):
+    # everything is drawn from a seeded generator, the same spec always gives the same pdf
+    rnd = random.Random(spec.seed)
+    fonts = FONTS[:max(1, min(spec.fonts, len(FONTS)))]
+    doc = fitz.open()
+
+    for _ in range(spec.pages):
+        page = doc.new_page()
+        y = 50.0
+        font = rnd.choice(fonts)
+        for line in range(spec.lines_per_page):
+            if rnd.random() < 0.15:
+                # paragraph break, sometimes with a font change
+                y += rnd.choice([6, 14, 24])
+                font = rnd.choice(fonts)
+            x = 50.0
+            for _ in range(spec.spans_per_line):
+                span_font = rnd.choice(fonts) if rnd.random() < 0.2 else font
+                text = " ".join(rnd.choice(WORDS) for _ in range(rnd.randint(1, 4)))
+                width = fitz.get_text_length(text, fontname=span_font, fontsize=9)
+                if x + width > page.rect.width - 40:
+                    break
+                page.insert_text((x, y), text, fontname=span_font, fontsize=9)
+                x += width + 6
+            y += 11
+            if y > page.rect.height - 60:
+                break
+
+        if spec.table_rows_per_page:
+            column_width = (page.rect.width - 100) / spec.table_columns
+            y += 10
+            for row in range(spec.table_rows_per_page):
+                if y + 14 > page.rect.height - 30:
+                    break
+                for column in range(spec.table_columns):
+                    x0 = 50 + column * column_width
+                    page.draw_rect(fitz.Rect(x0, y, x0 + column_width, y + 14), color=(0, 0, 0), width=0.5)
+                    page.insert_text((x0 + 2, y + 10), rnd.choice(WORDS), fontname="helv", fontsize=8)
+                y += 14
+
+    doc.set_metadata({})
+    # no_new_id keeps the file byte-identical between runs
+    doc.save(path, garbage=3, deflate=True, no_new_id=True)
+    doc.close()
+
+
+def generate_corpus(out_dir: Path, specs: List[CorpusSpec] = DEFAULT_CORPUS) -> List[Path]:
+    out_dir.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for spec in specs:
+        path = out_dir / f"{spec.name}.pdf"
+        generate_pdf(spec, path)
+        paths.append(path)
+    return paths
+
+
+def time_stages(pdf_path: Path, out_dir: Path) -> Dict[str, float]:
+    from mu_document_utils import DocumentWrapper, process_documents
+
+    timings = {}
+
+    def timed(stage, call):
+        start = time.perf_counter()
+        value = call()
+        timings[stage] = time.perf_counter() - start
+        return value
+
+    with fitz.open(pdf_path) as document:
+        doc = DocumentWrapper.from_document(document)
+        timed('scan_pages', doc.scan_pages)
+        has_table = timed('has_table', lambda: doc.has_table)
+        timed('parse_pdf_entries', doc.parse_pdf_entries)
+        timed('sanitize_parsed_pdf_entries', doc.sanitize_parsed_pdf_entries)
+        if has_table:
+            timed('apply_table_boundaries', doc.apply_table_boundaries)
+        else:
+            timings['apply_table_boundaries'] = 0.0
+        timed('collapse_parsed_entries_into_rows', doc.collapse_parsed_entries_into_rows)
+        timed('detect_connected_blocks_from_rows', doc.detect_connected_blocks_from_rows)
+        timed('dump_blocks_to_file', lambda: doc.dump_blocks_to_file(out_dir, pdf_path.stem))
+    timings['total'] = sum(timings.values())
+
+    # what extraction runs: the frame stages for table documents, block_engine for all others. the scan
+    # and the table detection are timed above, not part of this number (nor of the total)
+    with fitz.open(pdf_path) as document:
+        doc = DocumentWrapper.from_document(document)
+        doc.has_table
+        timed('process_documents', lambda: process_documents([doc]))
+    return timings
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True, cwd=Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def measure_imports(modules: List[str] = IMPORT_MODULES) -> dict:
+    # a fresh interpreter with -X importtime, every import is listed once with its cumulative microseconds,
+    # the ones it imports are indented below it, the top level ones add up to the total
+    completed = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {', '.join(modules)}"],
+                               capture_output=True, text=True, check=True, cwd=Path(__file__).parent)
+    loaded = []
+    total = 0
+    for line in completed.stderr.splitlines():
+        _, cumulative, name = line.split('|')
+        if not cumulative.strip().isdigit():
+            # the header line
+            continue
+        loaded.append(name.strip())
+        if not name[1:].startswith(' '):
+            total += int(cumulative)
+    return {'seconds': total / 1e6, 'modules': loaded}
+
+
+def check_imports(imports: dict, budget: float = IMPORT_TIME_BUDGET) -> List[str]:
+    problems = [f"imports {name}" for name in FORBIDDEN_IMPORTS
+                if any(module == name or module.startswith(name + '.') for module in imports['modules'])]
+    if imports['seconds'] > budget:
+        problems.append(f"imports take {imports['seconds']:.2f}s, the budget is {budget:.2f}s")
+    return problems
+
+
+def run_benchmark(work_dir: Path, repeats: int = 5, specs: List[CorpusSpec] = DEFAULT_CORPUS) -> dict:
+    import pandas as pd
+
+    pdfs = generate_corpus(work_dir / "corpus", specs)
+    out_dir = work_dir / "out"
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    documents = {}
+    for spec, pdf_path in zip(specs, pdfs):
+        runs = []
+        error = None
+        for _ in range(repeats):
+            try:
+                runs.append(time_stages(pdf_path, out_dir))
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+                break
+        documents[spec.name] = {
+            'spec': asdict(spec),
+            'error': error,
+            # the median is robust against the odd slow run, min shows the best case
+            'median': {stage: statistics.median(r[stage] for r in runs) for stage in runs[0]} if runs else {},
+            'min': {stage: min(r[stage] for r in runs) for stage in runs[0]} if runs else {},
+        }
+
+    return {
+        'format_version': BENCHMARK_FORMAT_VERSION,
+        'revision': _git_revision(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'pymupdf': fitz.VersionBind,
+        'pandas': pd.__version__,
+        'machine': platform.machine(),
+        'repeats': repeats,
+        'import_seconds': measure_imports()['seconds'],
+        'documents': documents,
+    }
+
+
+def compare_results(baseline: dict, current: dict,
+                    threshold: float = DEFAULT_REGRESSION_THRESHOLD) -> List[str]:
+    regressions = []
+    for name, current_doc in current['documents'].items():
+        baseline_doc = baseline['documents'].get(name)
+        if baseline_doc is None or not baseline_doc['median']:
+            continue
+        if current_doc['error'] and not baseline_doc['error']:
+            regressions.append(f"{name}: fails now ({current_doc['error']})")
+            continue
+        for stage, seconds in current_doc['median'].items():
+            before = baseline_doc['median'].get(stage)
+            # stages below a millisecond are all noise
+            if not before or max(before, seconds) < 1e-3:
+                continue
+            if seconds > before * threshold:
+                regressions.append(f"{name}/{stage}: {before * 1000:.2f}ms -> {seconds * 1000:.2f}ms "
+                                   f"({seconds / before:.2f}x)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="stage benchmark on a synthetic pdf corpus")
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    run = sub.add_parser('run')
+    run.add_argument('--work-dir', type=Path, default=Path('bench_work'))
+    run.add_argument('--repeats', type=int, default=5)
+    run.add_argument('--out', type=Path, default=None, help="default: bench_results.json in the work dir")
+
+    compare = sub.add_parser('compare')
+    compare.add_argument('baseline', type=Path)
+    compare.add_argument('current', type=Path)
+    compare.add_argument('--threshold', type=float, default=DEFAULT_REGRESSION_THRESHOLD)
+
+    imports = sub.add_parser('imports', help="fail when the extraction core imports too much or too slowly")
+    imports.add_argument('--budget', type=float, default=IMPORT_TIME_BUDGET)
+
+    args = parser.parse_args()
+    if args.command == 'imports':
+        result = measure_imports()
+        problems = check_imports(result, args.budget)
+        print(f"{', '.join(IMPORT_MODULES)}: {result['seconds'] * 1000:.0f}ms")
+        for line in problems:
+            print(line)
+        raise SystemExit(1 if problems else 0)
+    if args.command == 'run':
+        results = run_benchmark(args.work_dir, args.repeats)
+        (args.out or args.work_dir / 'bench_results.json').write_text(json.dumps(results, indent=2))
+        for name, doc in results['documents'].items():
+            total = doc['median'].get('total')
+            print(f"{name}: {total * 1000:.1f}ms" if total is not None else f"{name}: {doc['error']}")
+    else:
+        regressions = compare_results(json.loads(args.baseline.read_text()), json.loads(args.current.read_text()),
+                                      args.threshold)
+        for line in regressions:
+            print(line)
+        raise SystemExit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+import csv
+import io
+import os
+from typing import Dict, Mapping, Optional, Tuple
+
+import numpy as np
+
+from page_scanner import SPAN_DTYPES
+
+# spans -> rows -> text blocks on plain column arrays. no pandas here: the frames of DocumentWrapper are built
+# from these columns, documents without tables never need a frame (mu_document_utils.process_documents)
+
+# rows further apart than their own height plus this tolerance start a new block
+BLOCK_GAP_TOLERANCE = 3
+# same rule when the font changes between two rows, equal to BLOCK_GAP_TOLERANCE keeps font changes neutral
+BLOCK_FONT_CHANGE_GAP_TOLERANCE = 3
+
+# the spans of row i are collapsed_row_spans[span_start[i]:span_stop[i]], in reading order
+COLLAPSED_ROW_COLUMNS = [
+    'page', 'x0', 'y0', 'x1', 'y1', 'text_content', 'span_start', 'span_stop', 'font_flow_begin', 'font_flow_end',
+    'size_flow_begin', 'size_flow_end', 'height', 'width'
+]
+ROW_SPAN_COLUMNS = ['font', 'size', 'flag']
+
+TEXT_BLOCK_COLUMNS = ['page', 'block_id', 'text_content', 'x0', 'y0', 'x1', 'y1']
+TEXT_BLOCK_DTYPES = {
+    'page': SPAN_DTYPES['page'],
+    'block_id': np.int32,
+    'text_content': object,
+    **{column: SPAN_DTYPES[column] for column in ('x0', 'y0', 'x1', 'y1')},
+}
+
+
+def empty_blocks() -> Dict[str, np.ndarray]:
+    return {column: np.empty(0, dtype=dtype) for column, dtype in TEXT_BLOCK_DTYPES.items()}
+
+
+def missing_values(columns: Mapping[str, np.ndarray]) -> np.ndarray:
+    # spans with a missing value in any column, the rows DataFrame.dropna drops (NaN, None)
+    missing = np.zeros(len(columns['page']), dtype=bool)
+    for values in columns.values():
+        values = np.asarray(values)
+        if values.dtype == object:
+            missing |= np.fromiter((v is None or v != v for v in values.tolist()), dtype=bool, count=len(values))
+        elif values.dtype.kind == 'f':
+            missing |= np.isnan(values)
+    return missing
+
+
+def first_appearance_groups(*keys: np.ndarray) -> np.ndarray:
+    # number of the group of equal keys of every position, groups counted in the order they first appear
+    # (groupby(keys, sort=False).ngroup() without building a frame)
+    order = np.lexsort(keys[::-1])
+    if not len(order):
+        return np.empty(0, dtype=np.int64)
+    change = np.zeros(len(order) - 1, dtype=bool)
+    for key in keys:
+        key = np.asarray(key)[order]
+        change |= key[1:] != key[:-1]
+    run = np.cumsum(np.r_[False, change])
+    # the sort is stable, the first position of every run is the first appearance of its group
+    first = order[np.flatnonzero(np.r_[True, change])]
+    rank = np.empty(len(first), dtype=np.int64)
+    rank[np.argsort(first, kind='stable')] = np.arange(len(first))
+    groups = np.empty(len(order), dtype=np.int64)
+    groups[order] = rank[run]
+    return groups
+
+
+def collapse_rows(columns: Mapping[str, np.ndarray], font_codes: np.ndarray,
+                  documents: Optional[np.ndarray] = None) -> Tuple[Dict[str, np.ndarray], Dict[str, np.ndarray]]:
+    # the row columns (COLLAPSED_ROW_COLUMNS) and the span columns of the spans in columns (a frame or a dict
+    # of arrays), fonts stay the given codes. documents: document of every span when the spans of several
+    # documents come in one piece, rows never cross documents and keep their document in rows['doc']
+    page = np.asarray(columns['page'])
+    y1 = np.asarray(columns['y1'])
+    # one row per (page, y1) in order of first appearance, spans inside a row from left to right
+    row_keys = first_appearance_groups(page, y1) if documents is None else \
+        first_appearance_groups(documents, page, y1)
+    order = np.lexsort((np.asarray(columns['x0']), row_keys))
+    row_keys = row_keys[order]
+    starts = np.flatnonzero(np.r_[True, row_keys[1:] != row_keys[:-1]])
+    ends = np.r_[starts[1:], len(row_keys)]
+    last = ends - 1
+
+    page = page[order]
+    x0 = np.asarray(columns['x0'])[order]
+    y0 = np.asarray(columns['y0'])[order]
+    x1 = np.asarray(columns['x1'])[order]
+    y1 = y1[order]
+    texts = np.asarray(columns['text_content'], dtype=object)[order].tolist()
+    font_codes = np.asarray(font_codes)[order]
+    sizes = np.asarray(columns['size'])[order]
+
+    row_x0 = np.minimum.reduceat(x0, starts)
+    row_y0 = np.minimum.reduceat(y0, starts)
+    row_x1 = np.maximum.reduceat(x1, starts)
+    row_y1 = np.maximum.reduceat(y1, starts)
+
+    # the per-row lists of fonts, sizes and flags as flat columns in row order, rows keep the offsets
+    spans = {
+        'font': font_codes,
+        'size': sizes,
+        'flag': np.asarray(columns['flag'])[order],
+    }
+    rows = {
+        'page': page[starts],
+        'x0': row_x0,
+        'y0': row_y0,
+        'x1': row_x1,
+        'y1': row_y1,
+        'text_content': np.array([' '.join(texts[a:b]) for a, b in zip(starts, ends)], dtype=object),
+        'span_start': starts.astype(np.int32),
+        'span_stop': ends.astype(np.int32),
+        'font_flow_begin': font_codes[starts],
+        'font_flow_end': font_codes[last],
+        'size_flow_begin': sizes[starts],
+        'size_flow_end': sizes[last],
+        'height': (row_y1.astype(np.float64) - row_y0).astype(np.float32),
+        'width': (row_x1.astype(np.float64) - row_x0).astype(np.float32),
+    }
+    if documents is not None:
+        rows['doc'] = np.asarray(documents)[order][starts]
+    return rows, spans
+
+
+def detect_blocks(
+        rows: Mapping[str, np.ndarray],
+        documents: Optional[np.ndarray] = None,
+        gap_tolerance: float = BLOCK_GAP_TOLERANCE,
+        font_change_gap_tolerance: float = BLOCK_FONT_CHANGE_GAP_TOLERANCE,
+        split_on_upward_jump: bool = True,
+        separate: Optional[np.ndarray] = None,
+) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+    # the block id of every collapsed row and the text block columns, rows is a row frame or the columns of
+    # collapse_rows (fonts are compared by value or by code, that is the same). documents: document of every
+    # row when the rows of several documents come in one piece (in document order), every document opens a
+    # new block and counts its blocks from 1, the blocks get a 'doc' column. separate: rows that get a block
+    # of their own (merged tables, their height is the one of the whole table and would pull in the row above)
+    if len(rows['y0']) == 0:
+        blocks = empty_blocks()
+        if documents is not None:
+            blocks['doc'] = np.empty(0, dtype=np.asarray(documents).dtype)
+        return np.empty(0, dtype=np.int32), blocks
+
+    # compare every row with the one before it (the first row always opens block 1), distances are
+    # taken in float64, the stored float32 coordinates are exact but their differences are not
+    y0 = np.asarray(rows['y0'], dtype=np.float64)
+    prev_y0 = np.r_[y0[0], y0[:-1]]
+    font_begin = np.asarray(rows['font_flow_begin'])
+    prev_font_end = np.r_[font_begin[:1], np.asarray(rows['font_flow_end'])[:-1]]
+
+    # a row stays in the block while its distance to the previous row is within its own height
+    # plus the tolerance, a font change between the rows can use its own (stricter) tolerance
+    tolerance = np.where(font_begin != prev_font_end, font_change_gap_tolerance, gap_tolerance)
+    height = np.asarray(rows['y1'], dtype=np.float64) - y0
+    new_block = np.abs(y0 - prev_y0) > height + tolerance
+    if split_on_upward_jump:
+        # moving up means a new column or a new page
+        new_block |= y0 < prev_y0
+    if separate is not None:
+        separate = np.asarray(separate, dtype=bool)
+        new_block |= separate
+        new_block[1:] |= separate[:-1]
+    new_block[0] = True
+    if documents is not None:
+        documents = np.asarray(documents)
+        first = np.r_[True, documents[1:] != documents[:-1]]
+        new_block |= first
+
+    block_id = np.cumsum(new_block, dtype=np.int32)
+    if documents is not None:
+        # ids are increasing, the accumulated maximum carries the blocks before every document forward
+        block_id -= np.maximum.accumulate(np.where(first, block_id - 1, 0)).astype(np.int32)
+
+    # rows are in page order, so every (page, block_id) group is one contiguous run
+    page = np.asarray(rows['page'])
+    keys = (block_id, page) if documents is None else (block_id, page, documents)
+    order = np.lexsort(keys)
+    change = np.zeros(len(order) - 1, dtype=bool)
+    for key in keys:
+        key = key[order]
+        change |= key[1:] != key[:-1]
+    starts = np.flatnonzero(np.r_[True, change])
+    ends = np.r_[starts[1:], len(order)]
+    texts = np.asarray(rows['text_content'], dtype=object)[order].tolist()
+
+    blocks = {
+        'page': page[order][starts],
+        'block_id': block_id[order][starts],
+        'text_content': np.array(['\n'.join(texts[a:b]) for a, b in zip(starts, ends)], dtype=object),
+        'x0': np.minimum.reduceat(np.asarray(rows['x0'])[order], starts),
+        'y0': np.minimum.reduceat(np.asarray(rows['y0'])[order], starts),
+        'x1': np.maximum.reduceat(np.asarray(rows['x1'])[order], starts),
+        'y1': np.maximum.reduceat(np.asarray(rows['y1'])[order], starts),
+    }
+    if documents is not None:
+        blocks['doc'] = documents[order][starts]
+    return block_id, blocks
+
+
+def output_order(blocks: Mapping[str, np.ndarray]) -> np.ndarray:
+    # blocks by page and then y1, ties keep their order (what sort_values(by=['page', 'y1']) gives)
+    return np.lexsort((np.asarray(blocks['y1']), np.asarray(blocks['page'])))
+
+
+def render_text(texts) -> str:
+    # one tab separated line per block, quoted where needed: the bytes Series.to_csv(sep='\t', index=False,
+    # header=False) writes, pandas writes through the same csv writer
+    buffer = io.StringIO(newline='')
+    writer = csv.writer(buffer, delimiter='\t', lineterminator=os.linesep, quoting=csv.QUOTE_MINIMAL)
+    writer.writerows([text] for text in texts)
+    return buffer.getvalue()
@@ -1,4 +1,10 @@
+from pathlib import Path
+from typing import Union
+
 import fitz
 
-def parse_document(file_path) -> fitz.Document:
-    return fitz.open(file_path)
\ No newline at end of file
+def parse_document(source: Union[str, Path, bytes]) -> fitz.Document:
+    # bytes are pdfs that were already read into memory (see batch_io.Prefetcher)
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return fitz.open(stream=source, filetype="pdf")
+    return fitz.open(source)
@@ -0,0 +1,105 @@
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Iterator, List, Tuple
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from helper_classes import MyRect
+
+
+def _floats(values=()) -> np.ndarray:
+    return np.asarray(values, dtype=np.float64)
+
+
+def _pages(values=()) -> np.ndarray:
+    return np.asarray(values, dtype=np.int64)
+
+
+@dataclass
+class RectStore:
+    # struct of arrays, one entry per rectangle
+    page: np.ndarray = field(default_factory=_pages)
+    x0: np.ndarray = field(default_factory=_floats)
+    y0: np.ndarray = field(default_factory=_floats)
+    x1: np.ndarray = field(default_factory=_floats)
+    y1: np.ndarray = field(default_factory=_floats)
+
+    @classmethod
+    def from_arrays(cls, page, x0, y0, x1, y1) -> "RectStore":
+        return cls(page=_pages(page), x0=_floats(x0), y0=_floats(y0), x1=_floats(x1), y1=_floats(y1))
+
+    @classmethod
+    def concat(cls, stores: List["RectStore"]) -> "RectStore":
+        if not stores:
+            return cls()
+        return cls(*(np.concatenate([getattr(s, name) for s in stores]) for name in ('page', 'x0', 'y0', 'x1', 'y1')))
+
+    def __len__(self) -> int:
+        return len(self.page)
+
+    def __getitem__(self, selection) -> "RectStore":
+        # boolean masks and index arrays select a sub store
+        return RectStore(self.page[selection], self.x0[selection], self.y0[selection], self.x1[selection],
+                         self.y1[selection])
+
+    def __iter__(self) -> Iterator[Tuple["MyRect", int]]:
+        # view for callers that still expect the (MyRect, page) tuples, imported here so the arrays do not pull
+        # in pydantic
+        from helper_classes import MyRect
+        for page, x0, y0, x1, y1 in zip(self.page.tolist(), self.x0.tolist(), self.y0.tolist(), self.x1.tolist(),
+                                        self.y1.tolist()):
+            yield MyRect(x0=x0, y0=y0, x1=x1, y1=y1), page
+
+    @property
+    def width(self) -> np.ndarray:
+        return self.x1 - self.x0
+
+    @property
+    def height(self) -> np.ndarray:
+        return self.y1 - self.y0
+
+    def as_my_rects(self) -> List[Tuple["MyRect", int]]:
+        return list(self)
+
+
+@dataclass
+class LineStore:
+    # axis-parallel segments: position on the fixed axis (x of a vertical, y of a horizontal line)
+    # and the covered range on the other axis
+    page: np.ndarray = field(default_factory=_pages)
+    position: np.ndarray = field(default_factory=_floats)
+    start: np.ndarray = field(default_factory=_floats)
+    end: np.ndarray = field(default_factory=_floats)
+
+    @classmethod
+    def from_arrays(cls, page, position, start, end) -> "LineStore":
+        return cls(page=_pages(page), position=_floats(position), start=_floats(start), end=_floats(end))
+
+    def __len__(self) -> int:
+        return len(self.page)
+
+    def __getitem__(self, selection) -> "LineStore":
+        return LineStore(self.page[selection], self.position[selection], self.start[selection], self.end[selection])
+
+    def __iter__(self) -> Iterator[Tuple[int, float, float, float]]:
+        # same tuples the wrapper used to keep in its line lists
+        return zip(self.page.tolist(), self.position.tolist(), self.start.tolist(), self.end.tolist())
+
+
+def rect_edges(rects: RectStore) -> Tuple[LineStore, LineStore]:
+    # the left / right edges of every rect become vertical lines, top / bottom the horizontal ones,
+    # interleaved per rect like they were collected before
+    page = np.repeat(rects.page, 2)
+    vertical = LineStore(
+        page=page,
+        position=np.column_stack((rects.x0, rects.x1)).ravel(),
+        start=np.repeat(rects.y0, 2),
+        end=np.repeat(rects.y1, 2),
+    )
+    horizontal = LineStore(
+        page=page.copy(),
+        position=np.column_stack((rects.y0, rects.y1)).ravel(),
+        start=np.repeat(rects.x0, 2),
+        end=np.repeat(rects.x1, 2),
+    )
+    return vertical, horizontal
@@ -1,10 +1,8 @@
-import document_loader
 from pathlib import Path
-import time
-import random
-import string
 
-from mu_document_utils import DocumentWrapper
+import batch_extraction
+from batch_io import IOConfig
+from manifest import Manifest
 
 load_dir = Path.home() / "mnt/imi-dat/IMI-NLPCHIR/PDF/ARC_HUMBEF"
 
@@ -12,66 +10,69 @@ load_dir = Path.home() / "mnt/imi-dat/IMI-NLPCHIR/PDF/ARC_HUMBEF"
 save_dir_name = "test_out_final"
 write_out_dir_name = "with_pid_case"
 
+# limit of files per run, keep small while debugging
+max_files = 100
+# None uses one worker per core
+max_workers = None
+# how the annotated debug pdf is written: "full" re-saves the whole pdf, "incremental" appends the boxes to
+# a copy of the original, "overlay" writes a small pdf with nothing but the boxes
+annotation_mode = "incremental"
+# "text" writes one tsv per pdf, "jsonl" / "parquet" (needs pyarrow) append the blocks with page, block id,
+# bbox and table flag to shards in <output dir>/blocks, index.jsonl there maps every pdf to its shard and offset
+output_format = "text"
+# small pdfs (up to batch_extraction.MICRO_BATCH_MAX_PAGES pages) go to the workers this many at a time and share
+# one pass of the frame stages, same output as one by one. 1 sends every pdf on its own
+micro_batch = 16
+# pdfs read into memory ahead of the workers and outputs written behind them, the mount is slow
+io_config = IOConfig(read_ahead=8, write_behind=32)
+# local cache of the parsed pages and detected tables, keep it off the network mount
+cache_dir = Path.home() / ".cache/final-extractor"
+# per-document stage metrics (json lines) and the aggregate for the node exporter textfile collector
+metrics_json_path = Path("extraction_metrics.jsonl")
+metrics_prometheus_path = Path("extraction_metrics.prom")
+# local record of every pdf found under load_dir: size, mtime, hash, status, timings and outputs.
+# query it with `python manifest.py <path> failed|slow|summary`
+manifest_path = Path.home() / ".cache/final-extractor/manifest.sqlite"
+# re-stat every pdf, also finds files that were rewritten in place (same directory mtime)
+full_rescan = False
+# failed / crashed documents are only extracted again when asked for
+retry_failed = False
 
-def extract():
-    from statistics import mean, stdev  # local import to keep scope tight
-    pdfs_from_path = list(load_dir.glob("**/with_pid_case/*.pdf"))
-    i = 0
-    exec_times = []  # collect per-file execution times for the wrapped section
 
-    for pdf_path in pdfs_from_path:
-        if True:
-            # safe the output in the same basedir as we loaded from
-            target_path_output = pdf_path.parent / save_dir_name
-            target_path_output.mkdir(exist_ok=True)
-            # construct filename (that will be saved)
-            target_file_name = target_path_output / pdf_path.name
-            # check if file already exists
-            if target_file_name.exists():
-                continue
-            # start extraction
-            with document_loader.parse_document(pdf_path) as document:
-                doc = DocumentWrapper.from_document(document)
-                start_time = time.time()
-                has_table = doc.has_table
-                #print(has_table)
-                # get entries from pdf
-                doc.parse_pdf_entries()
-                # sanitize raw content
-                # Todo: check if add
-                #  additional algorithms need to be run before sanitation
-                doc.sanitize_parsed_pdf_entries()
-                if has_table:
-                    doc.apply_table_boundaries()
-                doc.collapse_parsed_entries_into_rows()
-                doc.detect_connected_blocks_from_rows()
-                doc.dump_blocks_to_file(load_dir / write_out_dir_name / save_dir_name, pdf_path.name.split(".")[0])
+def extract():
+    output_dir = load_dir / write_out_dir_name / save_dir_name
+    output_dir.mkdir(parents=True, exist_ok=True)
 
-                elapsed = time.time() - start_time  # measure only the currently wrapped section
-                exec_times.append(elapsed)
-                print(elapsed)
+    def existing_output(pdf_path: Path):
+        # pdfs extracted before the manifest existed. the outputs are named after the path below load_dir,
+        # a file named after the pdf alone may belong to a pdf of the same name in another directory
+        output_name = batch_extraction.output_name_for(pdf_path, load_dir)
+        output_file = batch_extraction.ExtractionJob(pdf_path, output_dir, output_name).output_file
+        return output_file if output_file.exists() else None
 
-                # optional for debugging detected stuff
-                doc.paint_and_write_boxes()
-                doc.close_and_save(load_dir / write_out_dir_name / save_dir_name / pdf_path.name)
-                #continue
-                #return
-        if i >= 100:
-            if exec_times:
-                m = mean(exec_times)
-                s = stdev(exec_times) if len(exec_times) > 1 else 0.0
-                print(f"\nMean execution time: {m:.4f}s | Std: {s:.4f}s over {len(exec_times)} file(s)")
-            return
-        else:
-            i+=1
-            continue
+    with Manifest(manifest_path) as manifest:
+        # only directories that changed since the last run are listed again
+        changed = manifest.discover(load_dir, "with_pid_case", full_rescan=full_rescan,
+                                    existing_output=existing_output)
+        # pending includes documents a crashed run did not finish
+        to_process = manifest.pending(limit=max_files, retry_failed=retry_failed)
+        print(f"{changed} new or changed pdfs, {len(to_process)} to process")
 
-    # if we finish without early return (fewer than 100 processed)
-    if exec_times:
-        m = mean(exec_times)
-        s = stdev(exec_times) if len(exec_times) > 1 else 0.0
-        print(f"\nMean execution time: {m:.4f}s | Std: {s:.4f}s over {len(exec_times)} file(s)")
+        # optional for debugging detected stuff: annotate=True writes the painted pdf next to the text output
+        # the annotated pdfs are written in the background while the next documents are extracted
+        jobs = batch_extraction.plan_jobs(to_process, output_dir, annotate=True, cache_dir=cache_dir,
+                                          collect_metrics=True, annotation_mode=annotation_mode,
+                                          content_hashes=manifest.content_hashes(to_process),
+                                          output_format=output_format, source_root=load_dir)
+        report = batch_extraction.run_batch(jobs, max_workers=max_workers, io_config=io_config, manifest=manifest,
+                                            micro_batch=micro_batch)
 
+    for result in report.failed:
+        print(f"\nFailed: {result.pdf_path}\n{result.error}")
+    for result in report.annotation_failed:
+        print(f"\nAnnotation failed: {result.pdf_path}\n{result.annotation_error}")
+    print(f"\n{report.summary()}")
+    report.write_metrics(metrics_json_path, metrics_prometheus_path)
 
 
 if __name__ == "__main__":
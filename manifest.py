@@ -0,0 +1,297 @@
+import argparse
+import json
+import os
+import sqlite3
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+SCHEMA_VERSION = 1
+
+# pending: never extracted or changed since, running: handed to a worker (left over after a crash),
+# writing: extracted, output still in the write-behind pool. all three are picked up again by pending()
+RESUMABLE_STATUSES = ('pending', 'running', 'writing')
+FAILED_STATUSES = ('failed', 'crashed')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime_ns INTEGER,
+    content_hash TEXT,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    elapsed REAL,
+    error TEXT,
+    output_file TEXT,
+    annotated_file TEXT,
+    stage_seconds TEXT,
+    updated REAL
+);
+CREATE INDEX IF NOT EXISTS documents_status ON documents (status);
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    subdirs TEXT NOT NULL,
+    files TEXT NOT NULL
+);
+"""
+
+
+@dataclass
+class DocumentRecord:
+    path: Path
+    size: Optional[int]
+    mtime_ns: Optional[int]
+    content_hash: Optional[str]
+    status: str
+    attempts: int
+    elapsed: Optional[float]
+    error: Optional[str]
+    output_file: Optional[Path]
+    annotated_file: Optional[Path]
+    # wall seconds per pipeline stage if the run collected metrics
+    stage_seconds: Dict[str, float]
+    updated: Optional[float]
+
+    @classmethod
+    def from_row(cls, row: sqlite3.Row) -> "DocumentRecord":
+        return cls(
+            path=Path(row['path']),
+            size=row['size'],
+            mtime_ns=row['mtime_ns'],
+            content_hash=row['content_hash'],
+            status=row['status'],
+            attempts=row['attempts'],
+            elapsed=row['elapsed'],
+            error=row['error'],
+            output_file=Path(row['output_file']) if row['output_file'] else None,
+            annotated_file=Path(row['annotated_file']) if row['annotated_file'] else None,
+            stage_seconds=json.loads(row['stage_seconds']) if row['stage_seconds'] else {},
+            updated=row['updated'],
+        )
+
+
+class Manifest:
+    # local sqlite file, keep it off the network mount. every record is committed on its own, a run that
+    # dies half way leaves everything it finished marked as done
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(self.path, isolation_level=None)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+        self._db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self) -> "Manifest":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def discover(self, root: Path, dir_name: str, suffix: str = '.pdf', full_rescan: bool = False,
+                 existing_output: Optional[Callable[[Path], Optional[Path]]] = None) -> int:
+        # same files as root.glob(f"**/{dir_name}/*{suffix}"). a directory whose mtime did not change has
+        # the same entries as last time, it is not listed again and its files are not stat'ed. files that
+        # are rewritten in place do not touch the directory mtime, full_rescan stats everything.
+        # existing_output(pdf) gives the output of a new file if it was already extracted before the
+        # manifest existed, such files start as done. returns the number of new or changed files
+        root = Path(root)
+        changed = 0
+        stack = [root]
+        self._db.execute("BEGIN")
+        try:
+            while stack:
+                directory = stack.pop()
+                try:
+                    mtime_ns = directory.stat().st_mtime_ns
+                except OSError:
+                    continue
+                cached = self._db.execute("SELECT * FROM directories WHERE path = ?", (str(directory),)).fetchone()
+                if cached is not None and cached['mtime_ns'] == mtime_ns and not full_rescan:
+                    stack.extend(directory / name for name in json.loads(cached['subdirs']))
+                    continue
+
+                listing = self._list_directory(directory, dir_name, suffix)
+                if listing is None:
+                    # could not list it (permissions, a flaky mount), that is not an empty directory. keep
+                    # what is known about it and try again next time, the old mtime stays so it is not skipped
+                    if cached is not None:
+                        stack.extend(directory / name for name in json.loads(cached['subdirs']))
+                    continue
+                subdirs, files = listing
+                self._db.execute(
+                    "INSERT OR REPLACE INTO directories (path, mtime_ns, subdirs, files) VALUES (?, ?, ?, ?)",
+                    (str(directory), mtime_ns, json.dumps(subdirs), json.dumps(files)),
+                )
+                if cached is not None:
+                    # a removed directory is not listed any more, everything below it goes with it
+                    for name in set(json.loads(cached['subdirs'])) - set(subdirs):
+                        self._forget_tree(directory / name)
+                if directory.name == dir_name:
+                    previous = set(json.loads(cached['files'])) if cached is not None else set()
+                    for name in previous - set(files):
+                        self._db.execute("DELETE FROM documents WHERE path = ?", (str(directory / name),))
+                    changed += sum(self._update_file(directory / name, existing_output) for name in files)
+                stack.extend(directory / name for name in subdirs)
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        return changed
+
+    def _forget_tree(self, directory: Path):
+        prefix = str(directory) + os.sep
+        for table in ('documents', 'directories'):
+            self._db.execute(f"DELETE FROM {table} WHERE path = ? OR substr(path, 1, ?) = ?",
+                             (str(directory), len(prefix), prefix))
+
+    @staticmethod
+    def _list_directory(directory: Path, dir_name: str, suffix: str) -> Optional[Tuple[List[str], List[str]]]:
+        # None if the directory can not be listed
+        subdirs = []
+        files = []
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                    elif directory.name == dir_name and entry.name.endswith(suffix) and entry.is_file():
+                        files.append(entry.name)
+        except OSError:
+            return None
+        return sorted(subdirs), sorted(files)
+
+    def _update_file(self, path: Path, existing_output: Optional[Callable[[Path], Optional[Path]]]) -> bool:
+        try:
+            stat = path.stat()
+        except OSError:
+            return False
+        row = self._db.execute("SELECT size, mtime_ns FROM documents WHERE path = ?", (str(path),)).fetchone()
+        if row is not None and row['size'] == stat.st_size and row['mtime_ns'] == stat.st_mtime_ns:
+            return False
+
+        status = 'pending'
+        output = None
+        if row is None and existing_output is not None:
+            output = existing_output(path)
+            if output is not None:
+                status = 'done'
+        # a changed file starts over, hash and results of the old content are gone
+        self._db.execute(
+            "INSERT OR REPLACE INTO documents (path, size, mtime_ns, status, output_file, updated) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (str(path), stat.st_size, stat.st_mtime_ns, status, str(output) if output else None, time.time()),
+        )
+        return True
+
+    def pending(self, limit: Optional[int] = None, retry_failed: bool = False) -> List[Path]:
+        statuses = RESUMABLE_STATUSES + (FAILED_STATUSES if retry_failed else ())
+        query = f"SELECT path FROM documents WHERE status IN ({', '.join('?' * len(statuses))}) ORDER BY path"
+        if limit is not None:
+            query += f" LIMIT {int(limit)}"
+        return [Path(row['path']) for row in self._db.execute(query, statuses)]
+
+    def content_hashes(self, paths: Iterable[Path]) -> Dict[Path, str]:
+        # hashes recorded by earlier attempts, the file did not change since (discover resets them)
+        hashes = {}
+        for path in paths:
+            row = self._db.execute("SELECT content_hash FROM documents WHERE path = ?", (str(path),)).fetchone()
+            if row is not None and row['content_hash']:
+                hashes[path] = row['content_hash']
+        return hashes
+
+    def mark_running(self, path: Path):
+        self._db.execute(
+            "UPDATE documents SET status = 'running', attempts = attempts + 1, updated = ? WHERE path = ?",
+            (time.time(), str(path)),
+        )
+
+    def record(self, result, content_hash: Optional[str] = None, output_file: Optional[Path] = None,
+               annotated_file: Optional[Path] = None, output_written: bool = True):
+        # result is a batch_extraction.ExtractionResult
+        if result.crashed:
+            status = 'crashed'
+        elif not result.ok:
+            status = 'failed'
+        else:
+            status = 'done' if output_written else 'writing'
+        stage_seconds = None
+        if result.metrics is not None:
+            stage_seconds = json.dumps({name: stage['wall_seconds'] for name, stage in result.metrics['stages'].items()})
+        # documents that were never discovered (plain lists of paths) get their row here
+        self._db.execute(
+            "INSERT INTO documents (path, size, status) VALUES (?, ?, 'pending') ON CONFLICT (path) DO NOTHING",
+            (str(result.pdf_path), result.file_size),
+        )
+        self._db.execute(
+            "UPDATE documents SET status = ?, content_hash = COALESCE(?, content_hash), elapsed = ?, error = ?, "
+            "output_file = ?, annotated_file = ?, stage_seconds = ?, updated = ? WHERE path = ?",
+            (status, content_hash, result.elapsed, result.error, str(output_file) if output_file else None,
+             str(annotated_file) if annotated_file else None, stage_seconds, time.time(), str(result.pdf_path)),
+        )
+
+    def mark_written(self, path: Path):
+        self._db.execute(
+            "UPDATE documents SET status = 'done', updated = ? WHERE path = ? AND status = 'writing'",
+            (time.time(), str(path)),
+        )
+
+    def set_error(self, path: Path, error: str):
+        self._db.execute("UPDATE documents SET status = 'failed', error = ?, updated = ? WHERE path = ?",
+                         (error, time.time(), str(path)))
+
+    def failed(self) -> List[DocumentRecord]:
+        rows = self._db.execute(
+            f"SELECT * FROM documents WHERE status IN ({', '.join('?' * len(FAILED_STATUSES))}) ORDER BY path",
+            FAILED_STATUSES,
+        )
+        return [DocumentRecord.from_row(row) for row in rows]
+
+    def slowest(self, n: int = 10) -> List[DocumentRecord]:
+        rows = self._db.execute(
+            "SELECT * FROM documents WHERE status = 'done' AND elapsed IS NOT NULL ORDER BY elapsed DESC LIMIT ?",
+            (n,),
+        )
+        return [DocumentRecord.from_row(row) for row in rows]
+
+    def status_counts(self) -> Dict[str, int]:
+        rows = self._db.execute("SELECT status, COUNT(*) AS n FROM documents GROUP BY status ORDER BY status")
+        return {row['status']: row['n'] for row in rows}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="query the extraction manifest")
+    parser.add_argument('manifest', type=Path)
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('summary')
+    failed = sub.add_parser('failed')
+    failed.add_argument('--errors', action='store_true', help="print the full error of every document")
+    slow = sub.add_parser('slow')
+    slow.add_argument('-n', type=int, default=10)
+
+    args = parser.parse_args()
+    with Manifest(args.manifest) as manifest:
+        if args.command == 'summary':
+            for status, count in manifest.status_counts().items():
+                print(f"{status}: {count}")
+        elif args.command == 'failed':
+            for record in manifest.failed():
+                last_line = (record.error or '').strip().splitlines()[-1:] or ['']
+                print(f"{record.path} [{record.status}, {record.attempts} attempt(s)] {last_line[0]}")
+                if args.errors and record.error:
+                    print(record.error)
+        else:
+            for record in manifest.slowest(args.n):
+                slowest_stage = max(record.stage_seconds.items(), key=lambda s: s[1], default=None)
+                stage = f" | slowest stage: {slowest_stage[0]} {slowest_stage[1]:.3f}s" if slowest_stage else ""
+                print(f"{record.elapsed:.3f}s {record.path}{stage}")
+
+
+if __name__ == "__main__":
+    main()
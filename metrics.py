@@ -0,0 +1,176 @@
+import functools
+import json
+import resource
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager
+from dataclasses import dataclass, field, asdict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from atomic_file import atomic_write
+
+METRIC_PREFIX = "final_extractor"
+
+# ru_maxrss is in KiB on linux and in bytes on macOS
+_MAXRSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+
+@dataclass
+class StageRecord:
+    calls: int = 0
+    wall_seconds: float = 0.0
+    cpu_seconds: float = 0.0
+    # python allocations only, 0 if memory tracking is off
+    peak_python_bytes: int = 0
+    # high-water mark of the whole process after the stage
+    max_rss_bytes: int = 0
+
+
+@dataclass
+class DocumentMetrics:
+    document: str
+    track_memory: bool = False
+    stages: Dict[str, StageRecord] = field(default_factory=dict)
+    counts: Dict[str, int] = field(default_factory=dict)
+
+    @contextmanager
+    def stage(self, name: str):
+        record = self.stages.setdefault(name, StageRecord())
+        tracing = self.track_memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        elif self.track_memory:
+            tracemalloc.reset_peak()
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield record
+        finally:
+            record.calls += 1
+            record.wall_seconds += time.perf_counter() - wall_start
+            record.cpu_seconds += time.process_time() - cpu_start
+            if self.track_memory:
+                record.peak_python_bytes = max(record.peak_python_bytes, tracemalloc.get_traced_memory()[1])
+            if tracing:
+                tracemalloc.stop()
+            record.max_rss_bytes = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _MAXRSS_UNIT
+
+    def add_share(self, name: str, record: StageRecord, share: float):
+        # a stage that ran once for several documents (mu_document_utils.process_documents), every document
+        # is charged its share of the time
+        own = self.stages.setdefault(name, StageRecord())
+        own.calls += 1
+        own.wall_seconds += record.wall_seconds * share
+        own.cpu_seconds += record.cpu_seconds * share
+        own.peak_python_bytes = max(own.peak_python_bytes, record.peak_python_bytes)
+        own.max_rss_bytes = max(own.max_rss_bytes, record.max_rss_bytes)
+
+    def to_dict(self) -> dict:
+        return {
+            'document': self.document,
+            'stages': {name: asdict(record) for name, record in self.stages.items()},
+            'counts': dict(self.counts),
+        }
+
+    def to_json(self) -> str:
+        return json.dumps(self.to_dict())
+
+
+def instrumented(stage: str):
+    # times the wrapped DocumentWrapper method if the wrapper carries metrics, otherwise it is a plain call
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.metrics is None:
+                return method(self, *args, **kwargs)
+            with self.metrics.stage(stage):
+                value = method(self, *args, **kwargs)
+            self.collect_counts()
+            return value
+
+        return wrapper
+
+    return decorator
+
+
+def append_json_records(path: Path, records: List[dict]):
+    with open(path, 'a', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record) + '\n')
+
+
+@dataclass
+class MetricsAggregate:
+    documents: int = 0
+    failed_documents: int = 0
+    stage_calls: Dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    stage_wall_seconds: Dict[str, float] = field(default_factory=lambda: defaultdict(float))
+    stage_cpu_seconds: Dict[str, float] = field(default_factory=lambda: defaultdict(float))
+    stage_peak_python_bytes: Dict[str, int] = field(default_factory=lambda: defaultdict(int))
+    max_rss_bytes: int = 0
+    counts: Dict[str, int] = field(default_factory=lambda: defaultdict(int))
+
+    def add(self, record: Optional[dict], failed: bool = False):
+        self.documents += 1
+        if failed:
+            self.failed_documents += 1
+        if record is None:
+            return
+        for name, stage in record['stages'].items():
+            self.stage_calls[name] += stage['calls']
+            self.stage_wall_seconds[name] += stage['wall_seconds']
+            self.stage_cpu_seconds[name] += stage['cpu_seconds']
+            self.stage_peak_python_bytes[name] = max(self.stage_peak_python_bytes[name],
+                                                     stage['peak_python_bytes'])
+            self.max_rss_bytes = max(self.max_rss_bytes, stage['max_rss_bytes'])
+        for name, value in record['counts'].items():
+            self.counts[name] += value
+
+    def to_prometheus(self) -> str:
+        p = METRIC_PREFIX
+        lines = [
+            f"# HELP {p}_documents_total Documents processed.",
+            f"# TYPE {p}_documents_total counter",
+            f"{p}_documents_total {self.documents}",
+            f"# HELP {p}_documents_failed_total Documents that failed.",
+            f"# TYPE {p}_documents_failed_total counter",
+            f"{p}_documents_failed_total {self.failed_documents}",
+            f"# HELP {p}_stage_calls_total Calls per pipeline stage.",
+            f"# TYPE {p}_stage_calls_total counter",
+        ]
+        lines += [f'{p}_stage_calls_total{{stage="{s}"}} {v}' for s, v in sorted(self.stage_calls.items())]
+        lines += [
+            f"# HELP {p}_stage_wall_seconds_total Wall time per pipeline stage.",
+            f"# TYPE {p}_stage_wall_seconds_total counter",
+        ]
+        lines += [f'{p}_stage_wall_seconds_total{{stage="{s}"}} {v:.6f}'
+                  for s, v in sorted(self.stage_wall_seconds.items())]
+        lines += [
+            f"# HELP {p}_stage_cpu_seconds_total CPU time per pipeline stage.",
+            f"# TYPE {p}_stage_cpu_seconds_total counter",
+        ]
+        lines += [f'{p}_stage_cpu_seconds_total{{stage="{s}"}} {v:.6f}'
+                  for s, v in sorted(self.stage_cpu_seconds.items())]
+        lines += [
+            f"# HELP {p}_stage_peak_python_bytes Largest python allocation peak of a stage.",
+            f"# TYPE {p}_stage_peak_python_bytes gauge",
+        ]
+        lines += [f'{p}_stage_peak_python_bytes{{stage="{s}"}} {v}'
+                  for s, v in sorted(self.stage_peak_python_bytes.items())]
+        lines += [
+            f"# HELP {p}_max_rss_bytes Largest resident set size of a worker.",
+            f"# TYPE {p}_max_rss_bytes gauge",
+            f"{p}_max_rss_bytes {self.max_rss_bytes}",
+            f"# HELP {p}_items_total Extracted items by kind (pages, spans, rects, table rows, blocks ...).",
+            f"# TYPE {p}_items_total counter",
+        ]
+        lines += [f'{p}_items_total{{kind="{k}"}} {v}' for k, v in sorted(self.counts.items())]
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: Path):
+        # textfile collectors may read at any time, never let them see a half written file
+        with atomic_write(path, encoding='utf-8') as f:
+            f.write(self.to_prometheus())
@@ -1,15 +1,37 @@
-import ast
-from collections import defaultdict
+import importlib
+import logging
+import sys
+from contextlib import nullcontext
 from dataclasses import dataclass, field
-from typing import List, Tuple, Dict
-from venv import logger
-from helper_functions import equals_within_boundary
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, List, Optional, Iterator, TextIO, Tuple
 
 import fitz
-import pandas as pd
-from traits.trait_types import false
-
-from helper_classes import MyRect, PyMuDataRowElement, PyMuCollapsedRowElement
+import numpy as np
+
+from page_scanner import PageScan, scan_page, scan_pages, scan_pages_parallel, concat_span_columns, SPAN_COLUMNS, \
+    SPAN_DTYPES, MIN_PAGES_FOR_PARALLEL_SCAN, AXIS_TOLERANCE, MIN_VERTICALS_FOR_TABLE
+from spatial_index import SpatialIndex
+from stage_cache import StageCache, hash_bytes
+from metrics import DocumentMetrics, instrumented
+from geometry import RectStore, LineStore
+from table_engine import Table, find_tables, grid_lines, SNAP_TOLERANCE, MIN_COLUMNS
+from table_render import bin_cells, get_renderer, DEFAULT_TABLE_FORMAT
+from annotation import AnnotationBoxes, paint_boxes
+from shard_output import BLOCK_RECORD_DTYPES, concat_block_records
+from block_engine import BLOCK_GAP_TOLERANCE, BLOCK_FONT_CHANGE_GAP_TOLERANCE, COLLAPSED_ROW_COLUMNS, \
+    ROW_SPAN_COLUMNS, TEXT_BLOCK_COLUMNS, collapse_rows, detect_blocks, empty_blocks, missing_values, \
+    output_order, render_text
+
+# pandas (frames) and pydantic (helper_classes, the validated paths) are imported where they are used: a
+# worker that only sees documents without tables never loads them, see process_documents
+if TYPE_CHECKING:
+    import pandas as pd
+
+# loaded by the first document of a process that needs the frames, see DocumentWrapper.import_frame_modules
+FRAME_MODULES = ('pandas', 'helper_classes')
+
+logger = logging.getLogger(__name__)
 
 MIN_LENGTH_X = 2
 MIN_LENGTH_Y = 2
@@ -19,111 +41,387 @@ MIN_HEIGHT_FOR_BOX = 2
 
 MIN_CELLS = 3
 
+# part of the cache key of the page scans: the triage decides which pages have their drawings collected and
+# the tolerance which lines are kept, cached scans are invalid once one of these changes
+SCAN_CONFIG = {
+    'triage': True,
+    'min_verticals_for_table': MIN_VERTICALS_FOR_TABLE,
+    'axis_tolerance': AXIS_TOLERANCE,
+}
+
+# part of the cache key of the table detection, cached rows are invalid once one of these changes
+TABLE_DETECTION_CONFIG = {
+    'snap_tolerance': SNAP_TOLERANCE,
+    'min_columns': MIN_COLUMNS,
+}
+
+# frame columns that are stored smaller than the float64 / int64 pandas defaults to, fonts are categoricals
+COMPACT_DTYPES = {
+    **{column: dtype for column, dtype in SPAN_DTYPES.items() if dtype is not object},
+    'span_start': np.int32,
+    'span_stop': np.int32,
+    'size_flow_begin': np.float32,
+    'size_flow_end': np.float32,
+    'height': np.float32,
+    'width': np.float32,
+    'block_id': np.int32,
+}
+FONT_COLUMNS = ('font', 'font_flow_begin', 'font_flow_end')
+
+
+def compact_frame(df: "pd.DataFrame") -> "pd.DataFrame":
+    # casts the known columns of a frame to the compact schema, used where frames are built from python objects
+    dtypes = {column: dtype for column, dtype in COMPACT_DTYPES.items() if column in df}
+    dtypes.update({column: 'category' for column in FONT_COLUMNS if column in df})
+    return df.astype(dtypes)
+
+
+def frame_memory(df: "pd.DataFrame") -> int:
+    # bytes of the frame including the python strings of object columns
+    return int(df.memory_usage(deep=True).sum())
+
+
+def _row_frames(rows: Dict[str, np.ndarray], spans: Dict[str, np.ndarray],
+                categories: "pd.Index") -> Tuple["pd.DataFrame", "pd.DataFrame"]:
+    # collapsed_pdf_rows and collapsed_row_spans from the columns of block_engine.collapse_rows
+    import pandas as pd
+
+    row_spans = pd.DataFrame({
+        'font': pd.Categorical.from_codes(spans['font'], categories),
+        'size': spans['size'],
+        'flag': spans['flag'],
+    })
+    collapsed_rows = pd.DataFrame({
+        column: pd.Categorical.from_codes(rows[column], categories) if column in FONT_COLUMNS else rows[column]
+        for column in COLLAPSED_ROW_COLUMNS
+    })
+    return collapsed_rows, row_spans
+
 
 @dataclass
 class DocumentWrapper:
     document: fitz.Document
-    vertical_lines: List[Tuple[int, float, float, float]] = field(default_factory=list)
-    horizontal_lines: List[Tuple[int, float, float, float]] = field(default_factory=list)
-    rects: List[Tuple["MyRect", int]] = field(default_factory=list)
-    table_rows: List[Tuple["MyRect", int]] = field(default_factory=list)
-    raw_pdf_content_elements: pd.DataFrame = field(default_factory=pd.DataFrame)
-    collapsed_pdf_rows: pd.DataFrame = field(default_factory=pd.DataFrame)
-    text_blocks: pd.DataFrame = field(default_factory=pd.DataFrame)
+    # iterating the stores yields the old (page, x, y0, y1) / (MyRect, page) tuples
+    vertical_lines: LineStore = field(default_factory=LineStore)
+    horizontal_lines: LineStore = field(default_factory=LineStore)
+    rects: RectStore = field(default_factory=RectStore)
+    table_rows: RectStore = field(default_factory=RectStore)
+    # whole tables reconstructed from the drawn grid lines, table_rows holds their rows
+    tables: List[Table] = field(default_factory=list)
+    # the frames of the stages, None until the stage ran (documents of process_documents without tables
+    # never get them, they only have blocks)
+    raw_pdf_content_elements: Optional["pd.DataFrame"] = None
+    collapsed_pdf_rows: Optional["pd.DataFrame"] = None
+    # font, size and flag of every span of the collapsed rows, see COLLAPSED_ROW_COLUMNS
+    collapsed_row_spans: Optional["pd.DataFrame"] = None
+    text_blocks: Optional["pd.DataFrame"] = None
+    # the text blocks (TEXT_BLOCK_COLUMNS) as plain arrays, in the order of text_blocks, set by the
+    # pandas-free path of process_documents instead of the frames
+    blocks: Optional[Dict[str, np.ndarray]] = None
+    page_scans: List[PageScan] = field(default_factory=list)
+    # > 1 scans the pages of large documents in that many processes
+    page_workers: int = 1
+    # raw pdf bytes if the document was opened from memory, page workers open their own handle from them
+    source_bytes: Optional[bytes] = None
+    # intermediate stages are loaded from / stored to this cache, keyed by the content hash of the pdf
+    cache: Optional[StageCache] = None
+    content_hash: Optional[str] = None
+    # stage timings and item counts, None keeps the instrumentation out of the way
+    metrics: Optional[DocumentMetrics] = None
+    # result of the table detection, None until it ran once
+    table_detected: Optional[bool] = None
+    # name of the renderer in table_render.TABLE_RENDERERS used for detected tables
+    table_format: str = DEFAULT_TABLE_FORMAT
 
     @classmethod
-    def from_document(cls, document: fitz.Document) -> "DocumentWrapper":
-        return cls(document=document)
-
+    def from_document(cls, document: fitz.Document, page_workers: int = 1, source_bytes: Optional[bytes] = None,
+                      cache: Optional[StageCache] = None, content_hash: Optional[str] = None,
+                      metrics: Optional[DocumentMetrics] = None,
+                      table_format: str = DEFAULT_TABLE_FORMAT) -> "DocumentWrapper":
+        # fail before any work is done on an unknown format
+        get_renderer(table_format)
+        wrapper = cls(document=document, page_workers=page_workers, source_bytes=source_bytes, cache=cache,
+                      content_hash=content_hash, metrics=metrics, table_format=table_format)
+        if cache is not None and content_hash is None:
+            wrapper.content_hash = hash_bytes(wrapper._document_bytes())
+        return wrapper
+
+    def collect_counts(self):
+        if self.metrics is None:
+            return
+        counts = self.metrics.counts
+        counts['pages'] = self.document.page_count
+        if self.page_scans:
+            counts['spans'] = sum(scan.span_count for scan in self.page_scans)
+            counts['pages_drawings_skipped'] = sum(scan.drawings_skipped for scan in self.page_scans)
+        counts['rects'] = len(self.rects)
+        counts['vertical_lines'] = len(self.vertical_lines)
+        counts['horizontal_lines'] = len(self.horizontal_lines)
+        counts['table_rows'] = len(self.table_rows)
+        if self.collapsed_pdf_rows is not None:
+            counts['collapsed_rows'] = len(self.collapsed_pdf_rows)
+        counts['blocks'] = len(self._blocks()['page'])
+        # deep memory usage walks every string, only measured when memory is tracked anyway
+        if self.metrics.track_memory:
+            counts.update({f'{name}_bytes': size for name, size in self.memory_footprint().items()})
+
+    def memory_footprint(self) -> Dict[str, int]:
+        # bytes held by each frame of the pipeline (the ones that were built)
+        frames = {
+            'raw_pdf_content_elements': self.raw_pdf_content_elements,
+            'collapsed_pdf_rows': self.collapsed_pdf_rows,
+            'collapsed_row_spans': self.collapsed_row_spans,
+            'text_blocks': self.text_blocks,
+        }
+        return {name: frame_memory(df) for name, df in frames.items() if df is not None}
+
+    @instrumented('close_and_save')
     def close_and_save(self, path):
         self.document.save(path)
 
 
 
+    def _blocks(self) -> Dict[str, np.ndarray]:
+        # the text blocks as columns, from whichever path built them
+        if self.blocks is not None:
+            return self.blocks
+        if self.text_blocks is None:
+            return empty_blocks()
+        return {column: self.text_blocks[column].to_numpy() for column in TEXT_BLOCK_COLUMNS}
+
+    def _blocks_for_output(self) -> Dict[str, np.ndarray]:
+        blocks = self._blocks()
+        order = output_order(blocks)
+        return {column: values[order] for column, values in blocks.items()}
+
+    @instrumented('dump_blocks_to_file')
     def dump_blocks_to_file(self, path, name):
-        df_serialize = self.text_blocks.copy()
-        df_serialize = df_serialize.sort_values(
-            by=['page', 'y1'],
-            ascending=[True, True]
-        )
         path_final = path / f"{name}.txt"
-         # df_serialize['text_content'].to_json(
-         #     path_final,
-         #      index=False,
-         #    force_ascii=False
-         # )
-        # df_serialize['text_content'].to_markdown(
-        #     path_final,
-        #     index=False
-        # )
-        (df_serialize['text_content']
-        .to_csv(
-             path_final,
-             sep='\t',
-             index=False,
-             header=False
-        ))
+        with open(path_final, 'w', encoding='utf-8', newline='') as f:
+            f.write(render_text(self._blocks_for_output()['text_content']))
+
+    @instrumented('dump_blocks_to_file')
+    def blocks_text(self) -> str:
+        # the content dump_blocks_to_file writes, for callers that write the file themselves
+        return render_text(self._blocks_for_output()['text_content'])
+
+    def _block_table_flags(self, blocks: Dict[str, np.ndarray]) -> np.ndarray:
+        # a block that overlaps a detected table carries the rendered table (only a few tables per page)
+        flags = np.zeros(len(blocks['page']), dtype=bool)
+        if not self.tables or not len(flags):
+            return flags
+        page = blocks['page']
+        x0, y0 = blocks['x0'].astype(np.float64), blocks['y0'].astype(np.float64)
+        x1, y1 = blocks['x1'].astype(np.float64), blocks['y1'].astype(np.float64)
+        tol = SNAP_TOLERANCE
+        for table in self.tables:
+            flags |= ((page == table.page) & (x0 <= table.x1 + tol) & (x1 >= table.x0 - tol)
+                      & (y0 <= table.y1 + tol) & (y1 >= table.y0 - tol))
+        return flags
+
+    @instrumented('block_records')
+    def block_records(self) -> Dict[str, np.ndarray]:
+        # the blocks in the order of the text output with their position, see shard_output.BLOCK_RECORD_DTYPES
+        blocks = self._blocks_for_output()
+        columns = {column: blocks[column].astype(dtype)
+                   for column, dtype in BLOCK_RECORD_DTYPES.items() if column in blocks}
+        columns['text'] = blocks['text_content'].astype(object)
+        columns['table'] = self._block_table_flags(blocks)
+        return {column: columns[column] for column in BLOCK_RECORD_DTYPES}
+
+    def import_frame_modules(self):
+        # the import is timed as a stage of its own, otherwise the first table document of every worker has
+        # it in its parse and table stage timings
+        missing = [module for module in FRAME_MODULES if module not in sys.modules]
+        if not missing:
+            return
+        with self.metrics.stage('frame_imports') if self.metrics is not None else nullcontext():
+            for module in missing:
+                importlib.import_module(module)
+
+    def iter_pages(self, **block_rules) -> Iterator["DocumentWrapper"]:
+        # streaming mode: every page runs through the whole pipeline on its own single-page wrapper,
+        # only one page worth of spans, rows and blocks is alive at a time
+        self.import_frame_modules()
+        block_offset = 0
+        for number in range(self.document.page_count):
+            page_doc = DocumentWrapper(document=self.document, table_format=self.table_format,
+                                       page_scans=[scan_page(self.document[number], number + 1)])
+            if self.metrics is not None:
+                counts = self.metrics.counts
+                counts['pages_drawings_skipped'] = counts.get('pages_drawings_skipped', 0) + \
+                    page_doc.page_scans[0].drawings_skipped
+            has_table = page_doc.has_table
+            page_doc.parse_pdf_entries()
+            page_doc.sanitize_parsed_pdf_entries()
+            if has_table:
+                page_doc.apply_table_boundaries()
+            page_doc.collapse_parsed_entries_into_rows()
+            page_doc.detect_connected_blocks_from_rows(**block_rules)
+            # keep block ids unique over the document
+            if not page_doc.text_blocks.empty:
+                page_doc.text_blocks['block_id'] += block_offset
+                block_offset = int(page_doc.text_blocks['block_id'].max())
+            # the scan is not needed any more once the page is done
+            page_doc.page_scans = []
+            yield page_doc
+
+    def stream_blocks_to_file(self, path, name, collect_boxes: bool = False,
+                              **block_rules) -> Optional[AnnotationBoxes]:
+        path_final = path / f"{name}.txt"
+        with open(path_final, 'w', encoding='utf-8', newline='') as f:
+            return self.stream_blocks(f, collect_boxes, **block_rules)
+
+    @instrumented('stream_blocks_to_file')
+    def stream_blocks(self, f: TextIO, collect_boxes: bool = False, **block_rules) -> Optional[AnnotationBoxes]:
+        # same output as dump_blocks_to_file, but appended to f page by page while the pages are processed,
+        # with collect_boxes the boxes to annotate are kept (a few arrays per page, not the pages)
+        boxes = []
+        for page_doc in self.iter_pages(**block_rules):
+            blocks = page_doc._blocks()
+            f.write(render_text(blocks['text_content'][np.argsort(blocks['y1'], kind='stable')]))
+            if collect_boxes:
+                boxes.append(page_doc.annotation_boxes())
+        return AnnotationBoxes.concat(boxes) if collect_boxes else None
+
+    @instrumented('stream_block_records')
+    def stream_block_records(self, collect_boxes: bool = False,
+                             **block_rules) -> Tuple[Dict[str, np.ndarray], Optional[AnnotationBoxes]]:
+        # block_records of the whole document, processed page by page like stream_blocks
+        records = []
+        boxes = []
+        for page_doc in self.iter_pages(**block_rules):
+            records.append(page_doc.block_records())
+            if collect_boxes:
+                boxes.append(page_doc.annotation_boxes())
+        return concat_block_records(records), AnnotationBoxes.concat(boxes) if collect_boxes else None
+
+    def annotation_boxes(self) -> AnnotationBoxes:
+        # what paint_and_write_boxes draws, small enough to hand to another process / thread
+        blocks = self._blocks()
+        if not len(blocks['page']):
+            return AnnotationBoxes(table_rows=self.table_rows)
+        return AnnotationBoxes(
+            blocks=RectStore.from_arrays(blocks['page'], blocks['x0'], blocks['y0'], blocks['x1'], blocks['y1']),
+            table_rows=self.table_rows,
+        )
 
+    @instrumented('paint_and_write_boxes')
     def paint_and_write_boxes(self):
-        for row in self.text_blocks.iterrows():
-            r = row[1]
-            page = self.document[r['page'] - 1]
-            box = r['box']
-            rect = fitz.Rect(box.x0, box.y0, box.x1, box.y1)
-            shape = page.new_shape()
-            shape.draw_rect(rect)
-            shape.finish(
-                color=(1, 0, 0),
-                width=0.5,
-                fill=None
-            )
-            shape.commit()
-        # DEBUG fraw lines
-        for rect, page in self.table_rows:
-            rect = fitz.Rect(rect.x0, rect.y0, rect.x1, rect.y1)
-            p = self.document[page - 1]
-            shape = p.new_shape()
-            shape.draw_rect(rect)
-            shape.finish(
-                color=(0, 1, 0),
-                width=1,
-                fill=None
-            )
-            shape.commit()
+        # blocks in red, table rows in green, batched into one shape per page
+        paint_boxes(self.document, self.annotation_boxes())
+
+    @instrumented('scan_pages')
+    def scan_pages(self) -> List[PageScan]:
+        # one pass over the pdf collects spans and drawings of every page, all later stages reuse it
+        if not self.page_scans and self.cache is not None:
+            self.page_scans = self.cache.load(self.content_hash, 'scan', config=SCAN_CONFIG) or []
+            if self.page_scans:
+                return self.page_scans
+
+        if not self.page_scans:
+            if self.page_workers > 1 and self.document.page_count >= MIN_PAGES_FOR_PARALLEL_SCAN:
+                # a document opened from its file is scanned from that file, nothing is copied
+                source = self.document.name if self.source_bytes is None and self.document.name \
+                    else self._document_bytes()
+                self.page_scans = scan_pages_parallel(source, self.document.page_count, self.page_workers,
+                                                      triage=SCAN_CONFIG['triage'])
+            else:
+                self.page_scans = scan_pages(self.document, triage=SCAN_CONFIG['triage'])
+            if self.cache is not None:
+                self.cache.store(self.content_hash, 'scan', self.page_scans, config=SCAN_CONFIG)
+        return self.page_scans
+
+    def _document_bytes(self) -> bytes:
+        if self.source_bytes is None:
+            # reading the file again is cheaper than serializing the opened document
+            self.source_bytes = Path(self.document.name).read_bytes() if self.document.name \
+                else self.document.tobytes()
+        return self.source_bytes
+
+    @instrumented('parse_pdf_entries')
+    def parse_pdf_entries(self, validate: bool = False):
+        # validate=True runs every span through the pydantic model, only meant for debugging
+        if validate:
+            self._parse_pdf_entries_validated()
+            return
+
+        import pandas as pd
+
+        columns = concat_span_columns(self.scan_pages())
+        # a handful of fonts per document, one code per span instead of one string reference
+        columns['font'] = pd.Categorical(columns['font'])
+        self.raw_pdf_content_elements = pd.DataFrame(columns)
+
+    def _parse_pdf_entries_validated(self):
+        import pandas as pd
+        from helper_classes import PyMuDataRowElement
 
-    def parse_pdf_entries(self):
         rows = []
-        for page_num, page in enumerate(self.document, start=1):
-            for block in page.get_text('dict')['blocks']:
-                if block['type'] != 0: continue
-                for line in block['lines']:
-                    for span in line['spans']:
-                        x0, y0, x1, y1 = span['bbox']
-                        rows.append(
-                            PyMuDataRowElement(
-                                page=page_num,
-                                x0=x0,
-                                y0=y0,
-                                x1=x1,
-                                y1=y1,
-                                text_content=span['text'],
-                                font=span['font'],
-                                size=span['size'],
-                                flag=span['flags']
-                            )
-                        )
+        for scan in self.scan_pages():
+            for x0, y0, x1, y1, text, font, size, flag in zip(
+                    *(scan.spans[column] for column in SPAN_COLUMNS[1:])
+            ):
+                rows.append(
+                    PyMuDataRowElement(
+                        page=scan.page_num,
+                        x0=x0,
+                        y0=y0,
+                        x1=x1,
+                        y1=y1,
+                        text_content=text,
+                        font=font,
+                        size=size,
+                        flag=flag
+                    )
+                )
 
         # prevent padnas from saving dicts
-        buffer = [row.dict() for row in rows]
-        self.raw_pdf_content_elements = pd.DataFrame(buffer)
+        buffer = [row.model_dump() for row in rows]
+        self.raw_pdf_content_elements = compact_frame(
+            pd.DataFrame(buffer, columns=list(PyMuDataRowElement.model_fields)))
 
+    @instrumented('sanitize_parsed_pdf_entries')
     def sanitize_parsed_pdf_entries(self):
+        import pandas as pd
+
         # replace empty text entries with NA so they can be dropped easily
         self.raw_pdf_content_elements.replace({'text': ' '}, {'text': pd.NA}, inplace=True)
         self.raw_pdf_content_elements.dropna(inplace=True)
 
     # Todo: implement alternative approach if there were tables detected in the beginning
-    def collapse_parsed_entries_into_rows(self):
+    @instrumented('collapse_parsed_entries_into_rows')
+    def collapse_parsed_entries_into_rows(self, validate: bool = False):
+        # validate=True runs the per-row pydantic implementation, kept as reference for debugging
+        if validate:
+            self._collapse_parsed_entries_into_rows_validated()
+            return
+
+        df = self.raw_pdf_content_elements
+        if df.empty:
+            self._set_empty_rows()
+            return
+
+        fonts = df['font'].astype('category')
+        rows, spans = collapse_rows(df, fonts.cat.codes.to_numpy())
+        self.collapsed_pdf_rows, self.collapsed_row_spans = _row_frames(rows, spans, fonts.cat.categories)
+
+    def _set_empty_rows(self):
+        import pandas as pd
+
+        self.collapsed_pdf_rows = compact_frame(pd.DataFrame(columns=COLLAPSED_ROW_COLUMNS))
+        self.collapsed_row_spans = compact_frame(pd.DataFrame(columns=ROW_SPAN_COLUMNS))
+
+    def row_span_values(self, column: str) -> List[list]:
+        # the old list column ('font', 'size' or 'flag' of every span) per collapsed row
+        values = self.collapsed_row_spans[column].tolist()
+        rows = self.collapsed_pdf_rows
+        return [values[a:b] for a, b in zip(rows['span_start'].tolist(), rows['span_stop'].tolist())]
+
+    def _collapse_parsed_entries_into_rows_validated(self):
+        import pandas as pd
+        from helper_classes import PyMuCollapsedRowElement
+
         grouped = []
         for (page, y1), group in self.raw_pdf_content_elements.groupby(['page', 'y1'], sort=False):
             group_sorted = group.sort_values(by='x0')  # order from left to right
@@ -147,295 +445,253 @@ class DocumentWrapper:
                     font_flow_end=fonts[-1] if fonts else None,
                     size_flow_begin=sizes[0] if sizes else None,
                     size_flow_end=sizes[-1] if sizes else None,
-                    flags=group_sorted['flag'],
+                    flags=group_sorted['flag'].tolist(),
                 )
             )
+        if not grouped:
+            self._set_empty_rows()
+            return
 
-        self.collapsed_pdf_rows = pd.DataFrame([
+        rows = pd.DataFrame([
             {
-                **g.dict(),
+                **g.model_dump(),
                 "height": g.get_height(),
                 "width": g.get_width()
             }
             for g in grouped
         ])
+        # same layout as the fast path: the lists flattened into collapsed_row_spans
+        span_stop = np.cumsum([len(g.fonts) for g in grouped])
+        rows['span_start'] = span_stop - [len(g.fonts) for g in grouped]
+        rows['span_stop'] = span_stop
+        self.collapsed_row_spans = compact_frame(pd.DataFrame({
+            'font': [font for g in grouped for font in g.fonts],
+            'size': [size for g in grouped for size in g.sizes],
+            'flag': [flag for g in grouped for flag in g.flags],
+        }))
+        self.collapsed_pdf_rows = compact_frame(rows[COLLAPSED_ROW_COLUMNS])
+
+    @instrumented('detect_connected_blocks_from_rows')
+    def detect_connected_blocks_from_rows(
+            self,
+            gap_tolerance: float = BLOCK_GAP_TOLERANCE,
+            font_change_gap_tolerance: float = BLOCK_FONT_CHANGE_GAP_TOLERANCE,
+            split_on_upward_jump: bool = True,
+    ):
+        import pandas as pd
+
+        rows = self.collapsed_pdf_rows
+        if rows.empty:
+            rows['block_id'] = pd.Series(dtype=np.int32)
+            self.text_blocks = compact_frame(pd.DataFrame(columns=TEXT_BLOCK_COLUMNS))
+            return
 
-    def detect_connected_blocks_from_rows(self):
-        block_ids = []
-        # helper variables
-        current_block = 0
-        prev_font_begin = None
-        prev_font_end = None
-        prev_size_begin = None
-        prev_size_end = None
-        prev_bottom = None
-
-        for idx, row in self.collapsed_pdf_rows.iterrows():
-            if idx == 0:
-                current_block = 1
-            else:
-                if row['y0'] < prev_bottom:
-                    current_block += 1
-                elif (row['font_flow_begin'] != prev_font_end and not equals_within_boundary(row['y0'], prev_bottom,
-                                                                                             row['height'] + 3)):
-                    current_block += 1
-                elif (row['font_flow_begin'] == prev_font_end and (
-                        abs(row['y0'] - prev_bottom) > row['height'] + 3)):
-                    current_block += 1
-
-            block_ids.append(current_block)
-            prev_font_begin = row['font_flow_begin']
-            prev_font_end = row['font_flow_end']
-            prev_size_begin = row['size_flow_begin']
-            prev_size_end = row['size_flow_end']
-            prev_bottom = row['y0']
-
-        self.collapsed_pdf_rows['block_id'] = block_ids
-        self.text_blocks = self.collapsed_pdf_rows.groupby(['page', 'block_id'], as_index=False).agg({
-            'text_content': lambda texts: '\n'.join(texts),
-            'x0': 'min',
-            'y0': 'min',
-            'x1': 'max',
-            'y1': 'max'
-        })
-
-        self.text_blocks['box'] = self.text_blocks.apply(
-            lambda _row: MyRect(
-                x0=_row['x0'],
-                y0=_row['y0'],
-                x1=_row['x1'],
-                y1=_row['y1']
-            ), axis=1
-        )
+        rows['block_id'], blocks = detect_blocks(rows, gap_tolerance=gap_tolerance,
+                                                 font_change_gap_tolerance=font_change_gap_tolerance,
+                                                 split_on_upward_jump=split_on_upward_jump,
+                                                 separate=self._table_row_mask(rows))
+        self.text_blocks = pd.DataFrame(blocks)
+
+    def _table_row_mask(self, rows: "pd.DataFrame") -> Optional[np.ndarray]:
+        # the rows apply_table_boundaries merged a table into: all spans inside a table became one row, so
+        # every row that lies inside a table is one
+        if not self.tables:
+            return None
+        page = rows['page'].to_numpy()
+        x0, y0 = rows['x0'].to_numpy(np.float64), rows['y0'].to_numpy(np.float64)
+        x1, y1 = rows['x1'].to_numpy(np.float64), rows['y1'].to_numpy(np.float64)
+        tol = SNAP_TOLERANCE
+        mask = np.zeros(len(rows), dtype=bool)
+        for table in self.tables:
+            mask |= ((page == table.page) & (x0 >= table.x0 - tol) & (x1 <= table.x1 + tol)
+                     & (y0 >= table.y0 - tol) & (y1 <= table.y1 + tol))
+        return mask
 
     @property
     def has_table(self) -> bool:
-        for page_num, page in enumerate(self.document, start=1):
-            drawings = page.get_drawings()
-            for entry in drawings:
-                for item in entry["items"]:
-                    # ToDo: for now only drawing with type 're' can be processed || Check for optimisations
-                    if item[0] != "re":
-                        continue
-
-                    x0, y0, x1, y1 = item[1]
-
-                    # only add drawings with min length in order to precent vector graphics from being processed
-                    if x1 - x0 > 2 or y1 - y0 > 2:
-                        my_rect = MyRect(x0=x0, y0=y0, x1=x1, y1=y1)
-                        try:
-                            self.rects.append((my_rect, int(page.number)))
-                        except TypeError as e:
-                            logger.error(e)
-
-                    # fill horizontal / vertical for now ToDo: change if needed
-
-                    if abs(y1 - y0) >= 0:
-                        try:
-                            # left
-                            self.vertical_lines.append((int(page.number), float(x0), float(y0), float(y1)))
-                            # right
-                            self.vertical_lines.append((int(page.number), float(x1), float(y0), float(y1)))
-                        except TypeError as e:
-                            logger.error(e)
-
-                    if abs(x1 - x0) >= 0:
-                        try:
-                            # top
-                            self.horizontal_lines.append((int(page.number), float(y0), float(x0), float(x1)))
-                            # bottom
-                            self.horizontal_lines.append((int(page.number), float(y1), float(x0), float(x1)))
-                        except TypeError as e:
-                            logger.error(e)
-
-        # no drawings mean table cant be detected ==> false
-        if len(self.rects) == 0:
-            return False
-
-        # this flag is used so that the last element in the iteration is also appended
-        append_prev = False
-        row_boxes: List[MyRect] = []
-
-        for i in range(len(self.rects) - 1):
-
-            current_row = self.rects[i]
-            next_row = self.rects[i + 1]
-
-            if (
-                    current_row[0].y1 - current_row[0].y1 == next_row[0].y1 - next_row[0].y1
-                    and next_row[0].x0 > current_row[0].x0
-                    and current_row[0].get_height() > 2
-            ):
-                row_boxes.append(current_row[0])
-                append_prev = True
-            elif (
-                    append_prev
-                    and current_row[0].y1 - current_row[0].y1 == next_row[0].y1 - next_row[0].y1
-                    and current_row[0].get_height() > 2
-            ):
-                row_boxes.append(current_row[0])
-
-        groups: Dict[float, List[MyRect]] = defaultdict(list)
-
-        for r in row_boxes:
-            groups[r.y1].append(r)
-
-        for y, group in groups.items():
-            # skip rows with less than MIN_CELLS cells
-            if len(group) < MIN_CELLS:
-                continue
-
-            x0 = min(r.x0 for r in group)
-            y0 = min(r.y0 for r in group)
-            x1 = max(r.x1 for r in group)
-            y1 = max(r.y1 for r in group)
+        # the detection runs once, repeated access must not collect the drawings again
+        if self.table_detected is None:
+            if self.cache is not None:
+                self._load_cached_tables()
+            if self.table_detected is None:
+                self.table_detected = self.detect_tables()
+                if self.cache is not None:
+                    self.cache.store(self.content_hash, 'tables', {
+                        'rects': self.rects,
+                        'vertical_lines': self.vertical_lines,
+                        'horizontal_lines': self.horizontal_lines,
+                        'table_rows': self.table_rows,
+                        'tables': self.tables,
+                        'table_detected': self.table_detected,
+                    }, config=TABLE_DETECTION_CONFIG)
+        return self.table_detected
+
+    def _load_cached_tables(self):
+        cached = self.cache.load(self.content_hash, 'tables', config=TABLE_DETECTION_CONFIG)
+        if cached is None:
+            return
+        self.rects = cached['rects']
+        self.vertical_lines = cached['vertical_lines']
+        self.horizontal_lines = cached['horizontal_lines']
+        self.table_rows = cached['table_rows']
+        self.tables = cached['tables']
+        self.table_detected = cached['table_detected']
+
+    @instrumented('has_table')
+    def detect_tables(self) -> bool:
+        scans = self.scan_pages()
+        drawn = RectStore.concat([
+            RectStore.from_arrays(np.full(len(scan.rects), scan.page_number), *np.reshape(scan.rects, (-1, 4)).T)
+            for scan in scans
+        ])
+        segments = RectStore.concat([
+            RectStore.from_arrays(np.full(len(scan.lines), scan.page_number), *np.reshape(scan.lines, (-1, 4)).T)
+            for scan in scans
+        ])
 
-            self.table_rows.append(
-                (MyRect(x0=x0, y0=y0, x1=x1, y1=y1), int(page.number))
-            )
+        # only keep drawings with min length in order to precent vector graphics from being processed
+        self.rects = drawn[(drawn.width > 2) | (drawn.height > 2)]
+        # rect edges and drawn lines, snapped together into grids per page
+        self.vertical_lines, self.horizontal_lines = grid_lines(self.rects, segments)
+        self.tables = find_tables(self.vertical_lines, self.horizontal_lines)
+        self.table_rows = RectStore.concat([table.row_rects() for table in self.tables])
 
-        return len(self.table_rows) > 0
+        return len(self.tables) > 0
 
+    @instrumented('apply_table_boundaries')
     def apply_table_boundaries(self):
 
-        if not self.table_rows or self.raw_pdf_content_elements.empty:
+        if not self.tables or self.raw_pdf_content_elements.empty:
             return
 
+        import pandas as pd
+        from helper_classes import PyMuDataRowElement
+
         df = self.raw_pdf_content_elements.copy()
         indices_to_drop: List[int] = []
 
-        # parse local lines list to dataframe for better processing
-        vertical_lines_df = pd.DataFrame(
-            self.vertical_lines,
-            columns=['page', 'x', 'y0', 'y1']
-        )
-
-        tol = 2  # pixel tolerance for collapsing near-duplicate verticals
-
-        for rect, page in self.table_rows:
+        # built once per document, every table is a rectangle query against it
+        span_index = SpatialIndex.from_frame(df)
+
+        # 1) pick up all text elements inside the table grids
+        tol = SNAP_TOLERANCE
+        tables = []
+        subsets = []
+        for table in self.tables:
+            positions = span_index.query(table.page, table.x0 - tol, table.y0 - tol, table.x1 + tol, table.y1 + tol)
+            if len(positions):
+                tables.append(table)
+                subsets.append(positions)
+        if not tables:
+            return
 
-            # 1) pick up all text elements inside this table-row bbox
-            mask = (
-                    (df["page"] == page)
-                    & (df["x0"] >= rect.x0)
-                    & (df["x1"] <= rect.x1)
-                    & (df["y0"] >= rect.y0)
-                    & (df["y1"] <= rect.y1)
-            )
-            subset = df[mask]
-            if subset.empty:
-                continue
-
-            # 2) find all vertical PDF-drawn lines inside the same bbox
-            vertical_bounding = vertical_lines_df[
-                (vertical_lines_df['page'] == page - 1)
-                & (vertical_lines_df['x'] >= rect.x0) & (vertical_lines_df['x'] <= rect.x1)
-                & (vertical_lines_df['y0'] >= rect.y0) & (vertical_lines_df['y1'] <= rect.y1)
-                ].reset_index(drop=True)
-
-            # 3) collapse near-duplicate verticals (remove duplicated lines in found df)
-            collapsed_vertical_boundings = []
-            last_kept = vertical_bounding.loc[0, 'x']
-            keep = [True]
-            for i in range(1, len(vertical_bounding)):
-                current = vertical_bounding.loc[i, 'x']
-                if current - last_kept > 2:
-                    keep.append(True)
-                    last_kept = current
-                else:
-                    keep.append(False)
-
-            # apply the created collapse mask on the original frame
-            collapsed_vertical_boundings = vertical_bounding[keep]
-
-            # 4) build cell-column boundaries by pairing consecutive verticals
-            cells = []
-            for i in range(0, len(collapsed_vertical_boundings)):
-                if i < len(collapsed_vertical_boundings) - 1:
-                    current_row = collapsed_vertical_boundings.iloc[i]
-                    next_row = collapsed_vertical_boundings.iloc[i + 1]
-                    bounding = {
-                        'page': page,
-                        'x0': current_row['x'],
-                        'x1': next_row['x']
-                    }
-                    cells.append(bounding)
-
-            cells_df = pd.DataFrame(cells)
-
-            # 5) for each cell, pull subset bits and join, then glue with "|"
-            # collapsed_cells_text = []
-            # for _, cell in cells_df.iterrows():
-            #     x0 = cell['x0']
-            #     x1 = cell['x1']
-            #
-            #     cell_items = subset[
-            #         (subset['x0'] >= x0) &
-            #         (subset['x1'] <= x1)
-            #         ]
-            #
-            #     collapsed_cells_text.append(
-            #         ' '.join(cell_items['text_content'].tolist())
-            #     )
-
-            merged_text = self.create_ascii_table(cells_df, subset)
-
-
-            # 6) build the merged row as before, but swap in our delimited text
-            first_index = subset.index[0]
+        # 2) assign the spans of all tables to their cells at once and render every table
+        positions = np.concatenate(subsets)
+        table_ids = np.repeat(np.arange(len(tables)), [len(p) for p in subsets])
+        grids = bin_cells(tables, table_ids, df['x0'].to_numpy()[positions], df['y0'].to_numpy()[positions],
+                          df['x1'].to_numpy()[positions], df['y1'].to_numpy()[positions],
+                          df['text_content'].to_numpy()[positions])
+        render = get_renderer(self.table_format)
+
+        # plain column arrays, a take on the frame has to interleave its mixed compact dtypes for every table
+        labels = df.index.to_numpy()
+        x0, y0, x1, y1 = (df[column].to_numpy() for column in ('x0', 'y0', 'x1', 'y1'))
+        fonts = df['font'].array
+        sizes = df['size'].to_numpy()
+        flags = df['flag'].to_numpy()
+
+        merged_rows = []
+        first_indices = []
+        for table, table_positions, grid in zip(tables, subsets, grids):
+            # 3) build the merged row as before, but swap in the rendered table
+            first = table_positions[0]
             merged = PyMuDataRowElement(
-                page=page,
-                x0=subset["x0"].min(),
-                y0=subset["y0"].min(),
-                x1=subset["x1"].max(),
-                y1=subset["y1"].max(),
-                text_content=merged_text,
-                font=subset.iloc[0]["font"],
-                size=subset.iloc[0]["size"],
-                flag=subset.iloc[0]["flag"],
+                page=table.page,
+                x0=x0[table_positions].min(),
+                y0=y0[table_positions].min(),
+                x1=x1[table_positions].max(),
+                y1=y1[table_positions].max(),
+                text_content=render(grid),
+                font=fonts[first],
+                size=sizes[first],
+                flag=flags[first],
             )
-
-            # replace the first row with the merged one
-            df.loc[first_index] = merged.model_dump()
+            merged_rows.append(merged.model_dump())
+            first_indices.append(labels[first])
 
             # mark the remaining rows for removal
-            indices_to_drop.extend(idx for idx in subset.index if idx != first_index)
+            indices_to_drop.extend(labels[table_positions[1:]].tolist())
+
+        # replace the first row of every table with its merged one, in one assignment
+        merged_df = pd.DataFrame(merged_rows, index=first_indices)
+        merged_df = merged_df.astype(df.dtypes[merged_df.columns].to_dict())
+        df.loc[first_indices, merged_df.columns] = merged_df
 
         if indices_to_drop:
             df.drop(index=indices_to_drop, inplace=True)
 
         self.raw_pdf_content_elements = df
 
-    def create_ascii_table(self, source_df, base_df) -> str:
-
-        row_cells = []
-
-        for _, cell in source_df.iterrows():
-            x0 = cell['x0']
-            x1 = cell['x1']
-
-            cell_items = base_df[
-                (base_df['x0'] >= x0) &
-                (base_df['x1'] <= x1)
-                ]
-
-            cell_text = ' '.join(cell_items['text_content'].tolist())
-            row_cells.append(cell_text)
-
-        #compute row cells
-        widths = [max(len(text), 1) for text in row_cells]
-        # build borders
-        horizontal_segments = ['─' * (w + 2) for w in widths]
-        top_border = '┌' + '┬'.join(horizontal_segments) + '┐'
-        bottom_border = '└' + '┴'.join(horizontal_segments) + '┘'
-
-        #build content line
-        padded_cells = [f" {text.ljust(widths[i])} " for i, text in enumerate(row_cells)]
-        content_line = '│' + '│'.join(padded_cells) + '│'
-
-        # assemble
-        ascii_table = '\n'.join([top_border, content_line, bottom_border])
 
-        return f"{ascii_table}"
-        # kepp for optional element adding
-        #return f"<pre>\n{ascii_table}\n</pre>"
+def process_documents(docs: List[DocumentWrapper], **block_rules):
+    # the blocks of many (small) documents at once. documents without tables take the pandas-free path:
+    # parse, sanitize, collapse and detect run once on the span columns of all of them (block_engine, the
+    # document is part of every key) and every document gets its share of the blocks in doc.blocks, the same
+    # blocks the frame stages give. documents with tables go through the frames one by one,
+    # apply_table_boundaries needs them
+    batched = []
+    for doc in docs:
+        doc.scan_pages()
+        if doc.has_table:
+            doc.import_frame_modules()
+            doc.parse_pdf_entries()
+            doc.sanitize_parsed_pdf_entries()
+            doc.apply_table_boundaries()
+            doc.collapse_parsed_entries_into_rows()
+            doc.detect_connected_blocks_from_rows(**block_rules)
+        else:
+            batched.append(doc)
+    if not batched:
+        return
+
+    # stages of the batch are timed once, every document gets the share of its spans
+    timer = DocumentMetrics('batch') if any(doc.metrics is not None for doc in batched) else None
+    stage = timer.stage if timer is not None else lambda name: nullcontext()
+
+    with stage('parse_pdf_entries'):
+        columns = [concat_span_columns(doc.scan_pages()) for doc in batched]
+        counts = np.array([len(c['page']) for c in columns])
+        spans = {column: np.concatenate([c[column] for c in columns]) for column in SPAN_COLUMNS}
+        documents = np.repeat(np.arange(len(batched), dtype=np.int32), counts)
+
+    with stage('sanitize_parsed_pdf_entries'):
+        # same spans as sanitize_parsed_pdf_entries: the ones with a missing value are dropped
+        keep = ~missing_values(spans)
+        if not keep.all():
+            spans = {column: values[keep] for column, values in spans.items()}
+            documents = documents[keep]
+
+    if not len(documents):
+        row_counts = np.zeros(len(batched), dtype=np.int64)
+        for doc in batched:
+            doc.blocks = empty_blocks()
+    else:
+        with stage('collapse_parsed_entries_into_rows'):
+            # codes into the sorted distinct fonts like the categorical of the frames, only compared for equality
+            _, font_codes = np.unique(spans['font'], return_inverse=True)
+            rows, _ = collapse_rows(spans, font_codes, documents)
+            row_counts = np.bincount(rows['doc'], minlength=len(batched))
+
+        with stage('detect_connected_blocks_from_rows'):
+            _, blocks = detect_blocks(rows, rows['doc'], **block_rules)
+            bounds = np.searchsorted(blocks['doc'], np.arange(len(batched) + 1))
+            for i, doc in enumerate(batched):
+                doc.blocks = {column: blocks[column][bounds[i]:bounds[i + 1]] for column in TEXT_BLOCK_COLUMNS}
+
+    for doc, share, row_count in zip(batched, counts / max(counts.sum(), 1), row_counts):
+        if doc.metrics is None:
+            continue
+        for name, record in timer.stages.items():
+            doc.metrics.add_share(name, record, share)
+        doc.collect_counts()
+        doc.metrics.counts['collapsed_rows'] = int(row_count)
@@ -0,0 +1,248 @@
+import os
+import re
+import sys
+import tempfile
+from array import array
+from concurrent.futures import Executor, ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import List, Tuple, Dict, Optional, Union
+
+import fitz
+import numpy as np
+
+from table_engine import MIN_COLUMNS
+
+# image blocks are skipped anyway, do not let MuPDF copy the image data into the page dict
+TEXT_EXTRACTION_FLAGS = fitz.TEXTFLAGS_DICT & ~fitz.TEXT_PRESERVE_IMAGES
+
+# MuPDF computes all coordinates and font sizes in single precision, float32 holds them exactly.
+# fonts stay python strings here (interned), parse_pdf_entries turns them into a categorical
+SPAN_DTYPES = {
+    'page': np.int32,
+    'x0': np.float32,
+    'y0': np.float32,
+    'x1': np.float32,
+    'y1': np.float32,
+    'text_content': object,
+    'font': object,
+    'size': np.float32,
+    'flag': np.int16,
+}
+SPAN_COLUMNS = list(SPAN_DTYPES)
+
+# a drawn line that leaves its axis by at most this much still counts as horizontal / vertical
+AXIS_TOLERANCE = 1
+
+# a ruled table needs at least this many vertical lines, pages whose content can not draw as many
+# skip get_drawings, every painted rect counts as two verticals and every painted line as one
+MIN_VERTICALS_FOR_TABLE = MIN_COLUMNS + 1
+
+# operators of the content stream that matter for the triage: path construction (re, l) and
+# everything that ends a path, a painted path draws its segments, 'n' (e.g. after a clip) does not.
+# operators are delimited by whitespace or the pdf delimiters, names like /F1 never match
+_PATH_OPERATOR = re.compile(rb'(?<![^\s)\]>}])(re|l|S|s|f\*?|F|B\*?|b\*?|n)(?=[\s(\[<{/%]|$)')
+_PAINT_OPERATORS = {b'S', b's', b'f', b'f*', b'F', b'B', b'B*', b'b', b'b*'}
+# path segments always follow their numeric operands, a stream without this has no rect or line at all
+_PATH_SEGMENT_HINT = re.compile(rb'\s(?:re|l)(?=[\s(\[<{/%]|$)')
+
+# documents below this page count are always scanned serially, a pool costs more than it saves
+MIN_PAGES_FOR_PARALLEL_SCAN = 16
+# page ranges per worker, more ranges than workers evens out pages of different density
+RANGES_PER_WORKER = 4
+
+
+@dataclass
+class PageScan:
+    # 1-based like the page column of the span table
+    page_num: int
+    spans: Dict[str, np.ndarray] = field(default_factory=dict)
+    # bboxes of the 're' drawing items in drawing order
+    rects: List[Tuple[float, float, float, float]] = field(default_factory=list)
+    # horizontal and vertical 'l' drawing items as (x0, y0, x1, y1), tables are often ruled with lines
+    lines: List[Tuple[float, float, float, float]] = field(default_factory=list)
+    # the triage ruled out a table on this page, rects / lines were not collected
+    drawings_skipped: bool = False
+
+    @property
+    def page_number(self) -> int:
+        # 0-based, what fitz reports as page.number
+        return self.page_num - 1
+
+    @property
+    def span_count(self) -> int:
+        return len(self.spans['page']) if self.spans else 0
+
+
+def count_painted_segments(content: bytes, min_verticals: Optional[int] = None) -> Tuple[int, int]:
+    # (rects, lines) of all painted paths of a content stream, text strings that happen to contain
+    # operator names can only add to the counts, never hide a drawing.
+    # with min_verticals the walk stops as soon as the page is known to need the drawings
+    rects = lines = 0
+    # the full operator walk is several times slower than this search, most text pages stop here,
+    # everything before the first segment can not paint anything either
+    first_segment = _PATH_SEGMENT_HINT.search(content)
+    if first_segment is None:
+        return rects, lines
+    pending_rects = pending_lines = 0
+    for match in _PATH_OPERATOR.finditer(content, first_segment.start() + 1):
+        op = match.group(1)
+        if op == b're':
+            pending_rects += 1
+        elif op == b'l':
+            pending_lines += 1
+        else:
+            if op in _PAINT_OPERATORS:
+                rects += pending_rects
+                lines += pending_lines
+                if min_verticals is not None and 2 * rects + lines >= min_verticals:
+                    break
+            pending_rects = pending_lines = 0
+    return rects, lines
+
+
+def page_may_have_table(page: fitz.Page, min_verticals: int = MIN_VERTICALS_FOR_TABLE) -> bool:
+    # reading the content stream is a fraction of what get_drawings costs, it only has to decide
+    # if the page can possibly hold a ruled table
+    document = page.parent
+    for xref, *_ in page.get_xobjects():
+        # a form can be drawn any number of times, any painted path in one keeps the page
+        if sum(count_painted_segments(document.xref_stream(xref) or b'', 1)):
+            return True
+    rects, lines = count_painted_segments(page.read_contents(), min_verticals)
+    return 2 * rects + lines >= min_verticals
+
+
+def scan_page(page: fitz.Page, page_num: int, triage: bool = True) -> PageScan:
+    # typed column buffers, filled straight from the page dict
+    x0s = array('f')
+    y0s = array('f')
+    x1s = array('f')
+    y1s = array('f')
+    sizes = array('f')
+    # span flags are a handful of bits, a value that does not fit raises instead of wrapping around
+    flags = array('h')
+    texts: List[str] = []
+    fonts: List[str] = []
+
+    for block in page.get_text('dict', flags=TEXT_EXTRACTION_FLAGS)['blocks']:
+        if block['type'] != 0: continue
+        for line in block['lines']:
+            for span in line['spans']:
+                x0, y0, x1, y1 = span['bbox']
+                x0s.append(x0)
+                y0s.append(y0)
+                x1s.append(x1)
+                y1s.append(y1)
+                texts.append(span['text'])
+                # only a handful of fonts per document, share one string object per name
+                fonts.append(sys.intern(span['font']))
+                sizes.append(span['size'])
+                flags.append(span['flags'])
+
+    rects = []
+    lines = []
+    skipped = triage and not page_may_have_table(page)
+    # get_cdrawings gives the same paths as get_drawings as plain tuples, without Rect / Point objects
+    for entry in ([] if skipped else page.get_cdrawings()):
+        for item in entry["items"]:
+            # ToDo: curves and quads are not processed || Check for optimisations
+            if item[0] == "re":
+                x0, y0, x1, y1 = item[1]
+                rects.append((float(x0), float(y0), float(x1), float(y1)))
+            elif item[0] == "l":
+                (ax, ay), (bx, by) = item[1], item[2]
+                # diagonal lines never belong to a table grid
+                if abs(ax - bx) <= AXIS_TOLERANCE or abs(ay - by) <= AXIS_TOLERANCE:
+                    lines.append((float(min(ax, bx)), float(min(ay, by)), float(max(ax, bx)), float(max(ay, by))))
+
+    spans = {
+        'page': np.full(len(texts), page_num, dtype=np.int32),
+        'x0': np.frombuffer(x0s, dtype=np.float32),
+        'y0': np.frombuffer(y0s, dtype=np.float32),
+        'x1': np.frombuffer(x1s, dtype=np.float32),
+        'y1': np.frombuffer(y1s, dtype=np.float32),
+        'text_content': np.array(texts, dtype=object),
+        'font': np.array(fonts, dtype=object),
+        'size': np.frombuffer(sizes, dtype=np.float32),
+        'flag': np.frombuffer(flags, dtype=np.int16),
+    }
+    return PageScan(page_num=page_num, spans=spans, rects=rects, lines=lines, drawings_skipped=skipped)
+
+
+def scan_pages(document: fitz.Document, start: int = 0, stop: Optional[int] = None,
+               triage: bool = True) -> List[PageScan]:
+    # start / stop are 0-based page numbers, every page is an independent unit of work
+    stop = document.page_count if stop is None else min(stop, document.page_count)
+    return [scan_page(document[number], number + 1, triage) for number in range(start, stop)]
+
+
+# worker side of scan_pages_parallel: the document of the last range, the next range of the same file reuses it
+_range_document: Optional[Tuple[tuple, fitz.Document]] = None
+
+
+def _scan_page_range(path: str, start: int, stop: int, triage: bool = True) -> List[PageScan]:
+    # every worker opens its own fitz handle, MuPDF documents can not be shared between processes. the
+    # file is opened once per worker, only (path, start, stop) travels with every range
+    global _range_document
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    if _range_document is None or _range_document[0] != key:
+        if _range_document is not None:
+            _range_document[1].close()
+        _range_document = (key, fitz.open(path))
+    return scan_pages(_range_document[1], start, stop, triage)
+
+
+def split_page_ranges(page_count: int, parts: int) -> List[Tuple[int, int]]:
+    size = max(1, -(-page_count // max(parts, 1)))
+    return [(start, min(start + size, page_count)) for start in range(0, page_count, size)]
+
+
+# the pool of scan_pages_parallel, started once per process and used for every large document
+_range_pool: Optional[Tuple[int, ProcessPoolExecutor]] = None
+
+
+def _shared_pool(workers: int) -> ProcessPoolExecutor:
+    global _range_pool
+    if _range_pool is None or _range_pool[0] != workers:
+        if _range_pool is not None:
+            _range_pool[1].shutdown(wait=False)
+        _range_pool = (workers, ProcessPoolExecutor(max_workers=workers))
+    return _range_pool[1]
+
+
+def scan_pages_parallel(
+        source: Union[bytes, str, Path],
+        page_count: int,
+        workers: Optional[int] = None,
+        executor: Optional[Executor] = None,
+        triage: bool = True,
+) -> List[PageScan]:
+    # source: the pdf file or its bytes, bytes are written to a temp file once instead of being sent
+    # with every range
+    workers = workers or os.cpu_count()
+    ranges = split_page_ranges(page_count, workers * RANGES_PER_WORKER)
+    pool = executor if executor is not None else _shared_pool(workers)
+
+    temp_path = None
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        fd, temp_path = tempfile.mkstemp(suffix='.pdf')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(source)
+        path = temp_path
+    else:
+        path = os.fspath(source)
+    try:
+        futures = [pool.submit(_scan_page_range, path, start, stop, triage) for start, stop in ranges]
+        # merged back in page order, the result is the same as a serial scan
+        return [scan for future in futures for scan in future.result()]
+    finally:
+        if temp_path is not None:
+            os.unlink(temp_path)
+
+
+def concat_span_columns(scans: List[PageScan]) -> Dict[str, np.ndarray]:
+    if not scans:
+        return {column: np.empty(0, dtype=dtype) for column, dtype in SPAN_DTYPES.items()}
+    return {column: np.concatenate([scan.spans[column] for scan in scans]) for column in SPAN_COLUMNS}
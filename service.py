@@ -0,0 +1,372 @@
+import argparse
+import json
+import logging
+import math
+import os
+import queue
+import signal
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlparse
+
+from batch_extraction import MAX_DOCUMENTS_PER_WORKER, ExtractionJob, WorkerSlot, extract_document
+from metrics import METRIC_PREFIX, MetricsAggregate
+from shard_output import records_to_dicts
+from table_render import DEFAULT_TABLE_FORMAT, get_renderer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 60.0
+# requests in flight or waiting for a worker, one more is turned away with 503
+DEFAULT_MAX_PENDING_PER_WORKER = 4
+# larger uploads are refused before they are read
+MAX_REQUEST_BYTES = 256 * 1024 * 1024
+
+
+@dataclass
+class ServiceConfig:
+    workers: int = field(default_factory=lambda: os.cpu_count() or 1)
+    max_pending: Optional[int] = None
+    # seconds from accepting a request until its result, including the wait for a free worker
+    timeout: float = DEFAULT_TIMEOUT
+    max_documents_per_worker: int = MAX_DOCUMENTS_PER_WORKER
+    # extraction by path is only allowed below these directories, None: only uploaded bytes
+    path_roots: Optional[List[Path]] = None
+    cache_dir: Optional[Path] = None
+    table_format: str = DEFAULT_TABLE_FORMAT
+
+    @property
+    def pending_limit(self) -> int:
+        return self.max_pending or self.workers * DEFAULT_MAX_PENDING_PER_WORKER
+
+
+class RequestError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def _warm_worker():
+    # runs once per worker process: pays the imports and the first-call costs of pandas / MuPDF up front. the
+    # warm up document has no table, pandas is imported explicitly so the first table document does not pay it
+    import fitz
+    import pandas as pd
+
+    with fitz.open() as document:
+        page = document.new_page()
+        for line in range(5):
+            page.insert_text((72, 72 + 14 * line), f"warm up line {line}", fontsize=10)
+        data = document.tobytes()
+    extract_document(ExtractionJob(pdf_path=Path('warmup.pdf'), output_dir=Path('.'), output_format='jsonl',
+                                   pdf_bytes=data))
+    pd.DataFrame({'page': [0, 0], 'y1': [2.0, 1.0]}).sort_values(by=['page', 'y1'])
+
+
+def _ping() -> int:
+    return os.getpid()
+
+
+class ExtractionService:
+    # a fixed set of warm single-process workers, every request borrows one for the length of one document
+    def __init__(self, config: ServiceConfig):
+        # a wrong format would fail every request
+        get_renderer(config.table_format)
+        self.config = config
+        self.started = time.time()
+        self._slots = [WorkerSlot(initializer=_warm_worker) for _ in range(config.workers)]
+        self._idle: "queue.Queue[WorkerSlot]" = queue.Queue()
+        self._admission = threading.BoundedSemaphore(config.pending_limit)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.requests: Dict[str, int] = {}
+        self.request_seconds = 0.0
+        self.aggregate = MetricsAggregate()
+        # the first request should not wait for the imports
+        for future in [slot.executor.submit(_ping) for slot in self._slots]:
+            future.result()
+        for slot in self._slots:
+            self._idle.put(slot)
+
+    def close(self):
+        for slot in self._slots:
+            slot.executor.shutdown(wait=False, cancel_futures=True)
+
+    def extract(self, pdf_bytes: Optional[bytes] = None, path: Optional[str] = None, name: Optional[str] = None,
+                table_rows: bool = False, timeout: Optional[float] = None) -> dict:
+        start = time.perf_counter()
+        status = 'ok'
+        try:
+            return self._extract(pdf_bytes, path, name, table_rows, timeout)
+        except RequestError as e:
+            status = str(e.status)
+            raise
+        finally:
+            with self._lock:
+                self.requests[status] = self.requests.get(status, 0) + 1
+                self.request_seconds += time.perf_counter() - start
+
+    def _extract(self, pdf_bytes: Optional[bytes], path: Optional[str], name: Optional[str], table_rows: bool,
+                 timeout: Optional[float]) -> dict:
+        if timeout is not None and not (math.isfinite(timeout) and timeout > 0):
+            raise RequestError(400, f"timeout must be a positive number of seconds, got {timeout}")
+        job = self._job(pdf_bytes, path, name, table_rows)
+        deadline = time.monotonic() + min(timeout or self.config.timeout, self.config.timeout)
+        if not self._admission.acquire(blocking=False):
+            raise RequestError(503, "too many pending requests")
+        try:
+            try:
+                slot = self._idle.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                raise RequestError(503, "no worker became free in time") from None
+            with self._lock:
+                self.in_flight += 1
+            try:
+                result = self._run(slot, job, deadline)
+            finally:
+                with self._lock:
+                    self.in_flight -= 1
+                self._idle.put(slot)
+        finally:
+            self._admission.release()
+
+        with self._lock:
+            self.aggregate.add(result.metrics, failed=not result.ok)
+        if not result.ok:
+            # the traceback stays in the log, the client gets its last line
+            logger.warning("extraction of %s failed:\n%s", job.pdf_path, result.error)
+            raise RequestError(422, result.error.strip().splitlines()[-1])
+        response = {
+            'document': str(job.pdf_path),
+            'page_count': result.metrics['counts'].get('pages') if result.metrics else None,
+            'elapsed': result.elapsed,
+            'blocks': records_to_dicts(result.output_records),
+        }
+        if table_rows:
+            # the boxes the annotation would paint green, one per detected table row
+            rows = result.annotation.table_rows
+            response['table_rows'] = [
+                {'page': page, 'x0': x0, 'y0': y0, 'x1': x1, 'y1': y1}
+                for page, x0, y0, x1, y1 in zip(rows.page.tolist(), rows.x0.tolist(), rows.y0.tolist(),
+                                                rows.x1.tolist(), rows.y1.tolist())
+            ]
+        return response
+
+    def _job(self, pdf_bytes: Optional[bytes], path: Optional[str], name: Optional[str],
+             table_rows: bool) -> ExtractionJob:
+        if (pdf_bytes is None) == (path is None):
+            raise RequestError(400, "send either the pdf bytes or a path")
+        resolved = None
+        if path is not None:
+            if not self.config.path_roots:
+                raise RequestError(403, "extraction by path is not enabled")
+            resolved = Path(path).resolve()
+            if not any(resolved.is_relative_to(root.resolve()) for root in self.config.path_roots):
+                raise RequestError(403, f"{path} is outside the allowed directories")
+            if not resolved.is_file():
+                raise RequestError(404, f"{path} does not exist")
+        # the block records come back in memory (the jsonl shard format), nothing is written
+        return ExtractionJob(
+            pdf_path=resolved if resolved is not None else Path(name or 'upload.pdf'),
+            output_dir=Path('.'),
+            output_format='jsonl',
+            pdf_bytes=pdf_bytes,
+            annotate=table_rows,
+            cache_dir=self.config.cache_dir,
+            table_format=self.config.table_format,
+            collect_metrics=True,
+        )
+
+    def _run(self, slot: WorkerSlot, job: ExtractionJob, deadline: float):
+        future = slot.executor.submit(extract_document, job)
+        try:
+            result = future.result(timeout=max(deadline - time.monotonic(), 0))
+        except FutureTimeout:
+            slot.kill()
+            slot.executor.submit(_ping)
+            raise RequestError(504, "extraction timed out") from None
+        except BrokenProcessPool:
+            slot.recycle()
+            slot.executor.submit(_ping)
+            raise RequestError(500, "worker process died while extracting this document") from None
+        slot.processed += 1
+        if slot.processed >= self.config.max_documents_per_worker:
+            # PyMuPDF does not give back all memory, the replacement warms up before its next document
+            slot.recycle()
+            slot.executor.submit(_ping)
+        return result
+
+    def health(self) -> dict:
+        with self._lock:
+            return {
+                'status': 'ok',
+                'workers': len(self._slots),
+                'idle_workers': self._idle.qsize(),
+                'in_flight': self.in_flight,
+                'uptime_seconds': round(time.time() - self.started, 3),
+            }
+
+    def prometheus(self) -> str:
+        p = METRIC_PREFIX
+        with self._lock:
+            lines = [
+                f"# HELP {p}_service_requests_total Extraction requests by outcome.",
+                f"# TYPE {p}_service_requests_total counter",
+            ]
+            lines += [f'{p}_service_requests_total{{status="{s}"}} {v}' for s, v in sorted(self.requests.items())]
+            lines += [
+                f"# HELP {p}_service_request_seconds_total Time from accepting to answering requests.",
+                f"# TYPE {p}_service_request_seconds_total counter",
+                f"{p}_service_request_seconds_total {self.request_seconds:.6f}",
+                f"# HELP {p}_service_in_flight Requests that hold a worker.",
+                f"# TYPE {p}_service_in_flight gauge",
+                f"{p}_service_in_flight {self.in_flight}",
+                f"# HELP {p}_service_workers Worker processes of the service.",
+                f"# TYPE {p}_service_workers gauge",
+                f"{p}_service_workers {len(self._slots)}",
+            ]
+            return '\n'.join(lines) + '\n' + self.aggregate.to_prometheus()
+
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    # POST /extract with the pdf as body (name, table_rows, timeout as query parameters) or a json body
+    # {"path": ..., "table_rows": bool, "timeout": seconds}. GET /health, GET /metrics
+    protocol_version = 'HTTP/1.1'
+    server: "ServiceHTTPServer"
+
+    def do_GET(self):
+        route = urlparse(self.path).path
+        if route == '/health':
+            self._send_json(200, self.server.service.health())
+        elif route == '/metrics':
+            self._send(200, self.server.service.prometheus().encode('utf-8'), 'text/plain; version=0.0.4')
+        else:
+            self._send_json(404, {'error': f"unknown path {route}"})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/extract':
+            self._send_json(404, {'error': f"unknown path {url.path}"})
+            return
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            if length > MAX_REQUEST_BYTES:
+                # the body is not read, the connection can not be reused
+                self.close_connection = True
+                raise RequestError(413, f"request larger than {MAX_REQUEST_BYTES} bytes")
+            body = self.rfile.read(length)
+            query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            if self.headers.get('Content-Type', '').startswith('application/json'):
+                try:
+                    options = json.loads(body or b'{}')
+                except ValueError:
+                    raise RequestError(400, "body is not valid json") from None
+                if not isinstance(options, dict):
+                    raise RequestError(400, "json body must be an object")
+                pdf_bytes = None
+            else:
+                options = query
+                pdf_bytes = body
+            response = self.server.service.extract(
+                pdf_bytes=pdf_bytes,
+                path=options.get('path'),
+                name=options.get('name'),
+                table_rows=str(options.get('table_rows', '')).lower() in ('1', 'true', 'yes'),
+                timeout=float(options['timeout']) if options.get('timeout') is not None else None,
+            )
+            self._send_json(200, response)
+        except RequestError as e:
+            self._send_json(e.status, {'error': str(e)})
+        except (ValueError, TypeError) as e:
+            self._send_json(400, {'error': str(e)})
+
+    def _send_json(self, status: int, payload: dict):
+        self._send(status, json.dumps(payload, ensure_ascii=False).encode('utf-8'), 'application/json')
+
+    def _send(self, status: int, body: bytes, content_type: str):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self) -> str:
+        # unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        logger.info("%s %s", self.address_string(), format % args)
+
+
+class ServiceHTTPServer(ThreadingHTTPServer):
+    def __init__(self, address: Tuple[str, int], service: ExtractionService):
+        self.service = service
+        super().__init__(address, ServiceRequestHandler)
+
+
+class UnixServiceHTTPServer(ServiceHTTPServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        # a socket file left behind by a killed service would make the bind fail
+        Path(self.server_address).unlink(missing_ok=True)
+        socketserver.TCPServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+def serve(config: ServiceConfig, host: str = '127.0.0.1', port: int = 8765, unix_socket: Optional[Path] = None):
+    service = ExtractionService(config)
+    if unix_socket is not None:
+        server = UnixServiceHTTPServer(str(unix_socket), service)
+        logger.info("serving on %s with %d workers", unix_socket, config.workers)
+    else:
+        server = ServiceHTTPServer((host, port), service)
+        logger.info("serving on http://%s:%d with %d workers", host, server.server_port, config.workers)
+
+    # serve_forever blocks this thread, shutdown has to come from another one
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+        if unix_socket is not None:
+            Path(unix_socket).unlink(missing_ok=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="extraction daemon with a warm worker pool")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--socket', type=Path, help="listen on this unix socket instead of tcp")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--max-pending', type=int, help="requests in flight or waiting (default 4 per worker)")
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT)
+    parser.add_argument('--path-root', type=Path, action='append',
+                        help="allow extraction by path below this directory (repeatable)")
+    parser.add_argument('--cache-dir', type=Path)
+    parser.add_argument('--table-format', default=DEFAULT_TABLE_FORMAT)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    serve(
+        ServiceConfig(workers=args.workers, max_pending=args.max_pending, timeout=args.timeout,
+                      path_roots=args.path_root, cache_dir=args.cache_dir, table_format=args.table_format),
+        host=args.host,
+        port=args.port,
+        unix_socket=args.socket,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+import importlib.util
+import json
+import os
+import re
+from dataclasses import dataclass, asdict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# text: one tsv per document (dump_blocks_to_file), the other formats append the blocks of all documents
+# to shared shards. parquet needs pyarrow, which is not a dependency of the extractor
+OUTPUT_FORMATS = ('text', 'jsonl', 'parquet')
+SHARD_FORMATS = ('jsonl', 'parquet')
+DEFAULT_OUTPUT_FORMAT = 'text'
+
+# the shards and their index live in this directory below the output dir
+SHARD_DIR_NAME = 'blocks'
+INDEX_FILE_NAME = 'index.jsonl'
+# a shard is sealed and a new one started once it holds about this much data
+SHARD_MAX_BYTES = 128 * 1024 * 1024
+# parquet only: blocks are buffered and written as row groups of about this many rows
+PARQUET_ROW_GROUP_ROWS = 64 * 1024
+
+# one record per text block, in the order of the text output (page, y1)
+BLOCK_RECORD_DTYPES = {
+    'page': np.int64,
+    'block_id': np.int64,
+    'x0': np.float64,
+    'y0': np.float64,
+    'x1': np.float64,
+    'y1': np.float64,
+    'text': object,
+    # the block overlaps a detected table, its text holds the rendered table
+    'table': np.bool_,
+}
+
+_SHARD_NAME = re.compile(r'blocks-(\d+)\.')
+
+
+def empty_block_records() -> Dict[str, np.ndarray]:
+    return {column: np.empty(0, dtype=dtype) for column, dtype in BLOCK_RECORD_DTYPES.items()}
+
+
+def concat_block_records(parts: List[Dict[str, np.ndarray]]) -> Dict[str, np.ndarray]:
+    if not parts:
+        return empty_block_records()
+    return {column: np.concatenate([part[column] for part in parts]) for column in BLOCK_RECORD_DTYPES}
+
+
+@dataclass
+class ShardIndexEntry:
+    document: str
+    # file name of the shard, relative to the shard directory
+    shard: str
+    # jsonl: byte offset of the first line of the document, parquet: row offset in the shard
+    offset: int
+    rows: int
+
+
+class ShardWriter:
+    # appends the block records of whole documents to size-bounded shards. the open shard is written as
+    # <name>.partial and renamed when it is sealed, only then its documents go to the index: readers never
+    # see half a shard and a crashed run leaves nothing in the index that can not be read
+    def __init__(self, directory: Path, output_format: str = 'jsonl', max_bytes: int = SHARD_MAX_BYTES):
+        if output_format not in SHARD_FORMATS:
+            raise ValueError(f"unknown shard format {output_format!r}, known: {', '.join(SHARD_FORMATS)}")
+        # pyarrow is only imported once a parquet shard is written
+        if output_format == 'parquet' and importlib.util.find_spec('pyarrow') is None:
+            raise ImportError("parquet shards need pyarrow, install it or use the jsonl format")
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.format = output_format
+        self.max_bytes = max_bytes
+        # documents of shards that were sealed since the last call of take_sealed
+        self._sealed: List[str] = []
+        self._next_number = max((int(m.group(1)) for m in map(_SHARD_NAME.match, os.listdir(self.directory))
+                                 if m is not None), default=-1) + 1
+        self._shard: Optional[str] = None
+        self._entries: List[ShardIndexEntry] = []
+        self._size = 0
+        self._rows = 0
+        self._file = None
+        # parquet: records not written as a row group yet
+        self._pending: List[Dict[str, np.ndarray]] = []
+        self._pending_rows = 0
+
+    def append(self, document: str, records: Dict[str, np.ndarray]):
+        if self._shard is None:
+            self._open()
+        rows = len(records['page'])
+        if self.format == 'jsonl':
+            offset = self._size
+            data = _encode_jsonl(document, records)
+            self._file.write(data)
+            self._size += len(data)
+        else:
+            offset = self._rows
+            self._pending.append({'document': np.full(rows, document, dtype=object), **records})
+            self._pending_rows += rows
+            # estimate, the compressed size is only known once the file is written
+            self._size += sum(len(t) for t in records['text'].tolist()) + 8 * len(BLOCK_RECORD_DTYPES) * rows
+            if self._pending_rows >= PARQUET_ROW_GROUP_ROWS:
+                self._write_row_group()
+        self._rows += rows
+        self._entries.append(ShardIndexEntry(document, self._shard, offset, rows))
+        if self._size >= self.max_bytes:
+            self._seal()
+
+    def take_sealed(self) -> List[str]:
+        # documents whose blocks are readable through the index now
+        sealed, self._sealed = self._sealed, []
+        return sealed
+
+    def close(self):
+        if self._shard is not None:
+            self._seal()
+
+    def _open(self):
+        self._shard = f"blocks-{self._next_number:05d}.{self.format}"
+        self._next_number += 1
+        self._entries = []
+        self._size = 0
+        self._rows = 0
+        if self.format == 'jsonl':
+            self._file = open(self._partial_path, 'wb')
+        else:
+            import pyarrow.parquet as pq
+            self._file = pq.ParquetWriter(self._partial_path, _parquet_schema())
+
+    @property
+    def _partial_path(self) -> Path:
+        return self.directory / f"{self._shard}.partial"
+
+    def _write_row_group(self):
+        if not self._pending:
+            return
+        import pyarrow as pa
+        columns = {column: np.concatenate([part[column] for part in self._pending])
+                   for column in ['document', *BLOCK_RECORD_DTYPES]}
+        self._file.write_table(pa.table(columns, schema=_parquet_schema()))
+        self._pending = []
+        self._pending_rows = 0
+
+    def _seal(self):
+        if self.format == 'parquet':
+            self._write_row_group()
+        self._file.close()
+        os.replace(self._partial_path, self.directory / self._shard)
+        with open(self.directory / INDEX_FILE_NAME, 'a', encoding='utf-8') as f:
+            for entry in self._entries:
+                f.write(json.dumps(asdict(entry), ensure_ascii=False) + '\n')
+        self._sealed.extend(entry.document for entry in self._entries)
+        self._shard = None
+        self._file = None
+
+
+def records_to_dicts(records: Dict[str, np.ndarray]) -> List[dict]:
+    # one plain dict (python scalars) per block
+    columns = [records[column].tolist() for column in BLOCK_RECORD_DTYPES]
+    return [dict(zip(BLOCK_RECORD_DTYPES, values)) for values in zip(*columns)]
+
+
+def _encode_jsonl(document: str, records: Dict[str, np.ndarray]) -> bytes:
+    lines = [json.dumps({'document': document, **record}, ensure_ascii=False) for record in records_to_dicts(records)]
+    return ''.join(line + '\n' for line in lines).encode('utf-8')
+
+
+def _parquet_schema():
+    import pyarrow as pa
+    return pa.schema([
+        ('document', pa.string()),
+        ('page', pa.int64()),
+        ('block_id', pa.int64()),
+        ('x0', pa.float64()),
+        ('y0', pa.float64()),
+        ('x1', pa.float64()),
+        ('y1', pa.float64()),
+        ('text', pa.string()),
+        ('table', pa.bool_()),
+    ])
+
+
+def load_index(directory: Path) -> Dict[str, ShardIndexEntry]:
+    # a document that was extracted again points to its latest shard
+    index = {}
+    path = Path(directory) / INDEX_FILE_NAME
+    if not path.exists():
+        return index
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            entry = ShardIndexEntry(**json.loads(line))
+            index[entry.document] = entry
+    return index
+
+
+def read_document(directory: Path, document: str,
+                  index: Optional[Dict[str, ShardIndexEntry]] = None) -> List[dict]:
+    # the block records of one document, without reading the rest of its shard
+    entry = (index if index is not None else load_index(directory))[document]
+    path = Path(directory) / entry.shard
+    if path.suffix == '.jsonl':
+        with open(path, 'rb') as f:
+            f.seek(entry.offset)
+            return [json.loads(f.readline()) for _ in range(entry.rows)]
+
+    import pyarrow.parquet as pq
+    parquet = pq.ParquetFile(path)
+    records = []
+    start = 0
+    # only the row groups that overlap the rows of the document are read
+    for group in range(parquet.num_row_groups):
+        stop = start + parquet.metadata.row_group(group).num_rows
+        if stop > entry.offset and start < entry.offset + entry.rows:
+            table = parquet.read_row_group(group)
+            low = max(entry.offset - start, 0)
+            high = min(entry.offset + entry.rows - start, table.num_rows)
+            records.extend(table.slice(low, high - low).to_pylist())
+        start = stop
+    return records
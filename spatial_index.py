@@ -0,0 +1,65 @@
+from typing import TYPE_CHECKING, Dict, Tuple
+
+import numpy as np
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+class SpatialIndex:
+    # per page the boxes are sorted by one coordinate (sort_by), a rectangle query binary searches
+    # that axis and only checks the remaining three bounds on the candidates in range
+    def __init__(self, pages, x0, y0, x1, y1, sort_by: str = 'y0'):
+        pages = np.asarray(pages)
+        columns = {
+            'x0': np.asarray(x0, dtype=np.float64),
+            'y0': np.asarray(y0, dtype=np.float64),
+            'x1': np.asarray(x1, dtype=np.float64),
+            'y1': np.asarray(y1, dtype=np.float64),
+        }
+        if sort_by not in ('x0', 'y0'):
+            raise ValueError(f"sort_by must be 'x0' or 'y0', got {sort_by!r}")
+        self.sort_by = sort_by
+
+        order = np.lexsort((columns[sort_by], pages))
+        self._positions = order
+        self._x0 = columns['x0'][order]
+        self._y0 = columns['y0'][order]
+        self._x1 = columns['x1'][order]
+        self._y1 = columns['y1'][order]
+        self._key = self._x0 if sort_by == 'x0' else self._y0
+
+        sorted_pages = pages[order]
+        page_values, starts = np.unique(sorted_pages, return_index=True)
+        ends = np.r_[starts[1:], len(sorted_pages)]
+        self._page_ranges: Dict[int, Tuple[int, int]] = {
+            int(page): (int(start), int(end)) for page, start, end in zip(page_values, starts, ends)
+        }
+
+    @classmethod
+    def from_frame(cls, df: "pd.DataFrame", sort_by: str = 'y0') -> "SpatialIndex":
+        return cls(df['page'], df['x0'], df['y0'], df['x1'], df['y1'], sort_by=sort_by)
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def query(self, page: int, x0: float, y0: float, x1: float, y1: float) -> np.ndarray:
+        # positions (in construction order, ascending) of all boxes on page fully inside the rectangle
+        page_range = self._page_ranges.get(int(page))
+        if page_range is None:
+            return np.empty(0, dtype=np.intp)
+        start, end = page_range
+
+        # the sort coordinate of a box inside the rect lies between the rect's lower and upper bound
+        low, high = (x0, x1) if self.sort_by == 'x0' else (y0, y1)
+        key = self._key[start:end]
+        lo = start + np.searchsorted(key, low, side='left')
+        hi = start + np.searchsorted(key, high, side='right')
+
+        inside = (
+                (self._x0[lo:hi] >= x0)
+                & (self._x1[lo:hi] <= x1)
+                & (self._y0[lo:hi] >= y0)
+                & (self._y1[lo:hi] <= y1)
+        )
+        return np.sort(self._positions[lo:hi][inside])
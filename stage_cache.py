@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+import pickle
+from pathlib import Path
+from typing import Any, Optional, Dict
+
+from atomic_file import atomic_write
+
+# bump a stage version whenever the stored result of that stage changes its shape or meaning
+STAGE_VERSIONS = {
+    'scan': 3,
+    'tables': 3,
+}
+
+DEFAULT_MAX_CACHE_BYTES = 4 * 1024 ** 3
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# the size of all entries as last counted, shared by the processes that use the cache: a new worker process
+# does not walk the whole cache before its first store
+SIZE_FILE_NAME = 'size'
+
+
+def hash_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_file(path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class StageCache:
+    # entries are pickled (protocol 5, numpy buffers are written as is) under the hash of
+    # pdf content + stage + stage version + stage config, the mtime of an entry is its last use
+    def __init__(self, root, max_bytes: int = DEFAULT_MAX_CACHE_BYTES):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+    def _path(self, content_hash: str, stage: str, config: Optional[Dict[str, Any]]) -> Path:
+        if stage not in STAGE_VERSIONS:
+            raise KeyError(f"unknown cache stage {stage!r}")
+        key_source = json.dumps(
+            [content_hash, stage, STAGE_VERSIONS[stage], config or {}],
+            sort_keys=True,
+            default=str,
+        )
+        key = hashlib.sha256(key_source.encode()).hexdigest()
+        return self.root / key[:2] / f"{key}.pkl"
+
+    def load(self, content_hash: str, stage: str, config: Optional[Dict[str, Any]] = None) -> Optional[Any]:
+        path = self._path(content_hash, stage, config)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # evicted by another process in the meantime, the loaded value is still fine
+            pass
+        return value
+
+    def store(self, content_hash: str, stage: str, value: Any, config: Optional[Dict[str, Any]] = None):
+        path = self._path(content_hash, stage, config)
+        path.parent.mkdir(exist_ok=True)
+        # concurrent workers must never see half an entry
+        with atomic_write(path) as f:
+            pickle.dump(value, f, protocol=5)
+
+        # read and written back without a lock, a store of another process can get lost in between. it is
+        # an estimate, every eviction counts again
+        size = self._read_size()
+        if size is None:
+            self.evict()
+            return
+        size += path.stat().st_size
+        if size > self.max_bytes:
+            self.evict()
+        else:
+            self._write_size(size)
+
+    def _read_size(self) -> Optional[int]:
+        try:
+            return int((self.root / SIZE_FILE_NAME).read_text())
+        except (OSError, ValueError):
+            return None
+
+    def _write_size(self, size: int):
+        try:
+            with atomic_write(self.root / SIZE_FILE_NAME, encoding='utf-8') as f:
+                f.write(str(size))
+        except OSError:
+            # only an estimate, the next store or evict writes it again
+            pass
+
+    def evict(self):
+        entries = []
+        for path in self.root.glob('*/*.pkl'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        # least recently used first
+        for _, size, path in sorted(entries, key=lambda e: e[0]):
+            if total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+        self._write_size(total)
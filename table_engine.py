@@ -0,0 +1,194 @@
+from bisect import bisect_left, bisect_right, insort
+from dataclasses import dataclass
+from typing import List, Tuple
+
+import numpy as np
+
+from geometry import RectStore, LineStore, rect_edges
+
+# coordinates closer than this are the same grid line
+SNAP_TOLERANCE = 2
+# a table needs at least this many columns, same threshold the per-row detection used for cells
+MIN_COLUMNS = 3
+# segments shorter than this are drawing noise (e.g. the short sides of a thin rule drawn as rect)
+MIN_SEGMENT_LENGTH = 2
+
+
+@dataclass
+class Table:
+    # 1-based like the page column of the span table
+    page: int
+    # sorted, snapped grid lines: n_rows + 1 y values and n_columns + 1 x values
+    row_bounds: np.ndarray
+    column_bounds: np.ndarray
+
+    @property
+    def x0(self) -> float:
+        return float(self.column_bounds[0])
+
+    @property
+    def y0(self) -> float:
+        return float(self.row_bounds[0])
+
+    @property
+    def x1(self) -> float:
+        return float(self.column_bounds[-1])
+
+    @property
+    def y1(self) -> float:
+        return float(self.row_bounds[-1])
+
+    @property
+    def n_rows(self) -> int:
+        return len(self.row_bounds) - 1
+
+    @property
+    def n_columns(self) -> int:
+        return len(self.column_bounds) - 1
+
+    def row_rects(self) -> RectStore:
+        return RectStore.from_arrays(
+            np.full(self.n_rows, self.page),
+            np.full(self.n_rows, self.x0),
+            self.row_bounds[:-1],
+            np.full(self.n_rows, self.x1),
+            self.row_bounds[1:],
+        )
+
+
+def grid_lines(rects: RectStore, segments: RectStore,
+               tolerance: float = SNAP_TOLERANCE) -> Tuple[LineStore, LineStore]:
+    # rects contribute their four edges, thin rects (rules drawn as filled boxes) and drawn line
+    # segments (given as their bbox) count as one line on their long axis
+    thin_h = (rects.height <= tolerance) & (rects.width > rects.height)
+    thin_v = (rects.width <= tolerance) & ~thin_h
+    boxes = rects[~(thin_h | thin_v)]
+    vertical, horizontal = rect_edges(boxes)
+
+    seg_h = segments.height <= segments.width
+    as_horizontal = RectStore.concat([rects[thin_h], segments[seg_h]])
+    as_vertical = RectStore.concat([rects[thin_v], segments[~seg_h]])
+
+    vertical = LineStore(
+        page=np.r_[vertical.page, as_vertical.page],
+        position=np.r_[vertical.position, (as_vertical.x0 + as_vertical.x1) / 2],
+        start=np.r_[vertical.start, as_vertical.y0],
+        end=np.r_[vertical.end, as_vertical.y1],
+    )
+    horizontal = LineStore(
+        page=np.r_[horizontal.page, as_horizontal.page],
+        position=np.r_[horizontal.position, (as_horizontal.y0 + as_horizontal.y1) / 2],
+        start=np.r_[horizontal.start, as_horizontal.x0],
+        end=np.r_[horizontal.end, as_horizontal.x1],
+    )
+    return vertical, horizontal
+
+
+def snap(values: np.ndarray, tolerance: float = SNAP_TOLERANCE) -> np.ndarray:
+    # sorted values are chained into clusters while neighbours are within the tolerance,
+    # every value is replaced by the mean of its cluster
+    if len(values) == 0:
+        return values.astype(np.float64)
+    order = np.argsort(values, kind='stable')
+    sorted_values = values[order]
+    cluster = np.r_[0, np.cumsum(np.diff(sorted_values) > tolerance)]
+    means = np.bincount(cluster, weights=sorted_values) / np.bincount(cluster)
+    snapped = np.empty(len(values), dtype=np.float64)
+    snapped[order] = means[cluster]
+    return snapped
+
+
+def _find(parent: List[int], i: int) -> int:
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+def _connect_crossing_segments(horizontal: Tuple[np.ndarray, np.ndarray, np.ndarray],
+                               vertical: Tuple[np.ndarray, np.ndarray, np.ndarray],
+                               tolerance: float) -> List[int]:
+    # sweep over x: a horizontal segment is active between its (widened) ends, every vertical segment
+    # is joined with the active horizontals whose y lies on it, union-find keeps the connected grids
+    h_y, h_x0, h_x1 = horizontal
+    v_x, v_y0, v_y1 = vertical
+    n_h = len(h_y)
+    parent = list(range(n_h + len(v_x)))
+
+    # event kinds sort inserts before queries before removals at the same x
+    events = [(x0 - tolerance, 0, i) for i, x0 in enumerate(h_x0.tolist())]
+    events += [(x, 1, i) for i, x in enumerate(v_x.tolist())]
+    events += [(x1 + tolerance, 2, i) for i, x1 in enumerate(h_x1.tolist())]
+    events.sort()
+
+    active: List[Tuple[float, int]] = []
+    h_y_list = h_y.tolist()
+    v_y0_list = v_y0.tolist()
+    v_y1_list = v_y1.tolist()
+    for _, kind, i in events:
+        if kind == 0:
+            insort(active, (h_y_list[i], i))
+        elif kind == 2:
+            del active[bisect_left(active, (h_y_list[i], i))]
+        else:
+            lo = bisect_left(active, (v_y0_list[i] - tolerance, -1))
+            hi = bisect_right(active, (v_y1_list[i] + tolerance, n_h))
+            root = _find(parent, n_h + i)
+            for _, h in active[lo:hi]:
+                other = _find(parent, h)
+                if other != root:
+                    parent[other] = root
+
+    return [_find(parent, i) for i in range(len(parent))]
+
+
+def find_page_tables(page: int, vertical: LineStore, horizontal: LineStore,
+                     tolerance: float = SNAP_TOLERANCE, min_columns: int = MIN_COLUMNS) -> List[Table]:
+    # vertical / horizontal hold the segments of one page only
+    vertical = vertical[(vertical.end - vertical.start) >= MIN_SEGMENT_LENGTH]
+    horizontal = horizontal[(horizontal.end - horizontal.start) >= MIN_SEGMENT_LENGTH]
+    if len(vertical) < min_columns + 1 or len(horizontal) < 2:
+        return []
+
+    h_y = snap(horizontal.position, tolerance)
+    v_x = snap(vertical.position, tolerance)
+    roots = np.asarray(_connect_crossing_segments(
+        (h_y, horizontal.start, horizontal.end),
+        (v_x, vertical.start, vertical.end),
+        tolerance,
+    ))
+    h_roots = roots[:len(h_y)]
+    v_roots = roots[len(h_y):]
+
+    # stray lines form components too, only look at the ones with enough verticals for a table
+    v_components, v_counts = np.unique(v_roots, return_counts=True)
+    tables = []
+    for root in v_components[v_counts >= min_columns + 1]:
+        row_bounds = np.unique(h_y[h_roots == root])
+        column_bounds = np.unique(v_x[v_roots == root])
+        if len(row_bounds) < 2 or len(column_bounds) < min_columns + 1:
+            continue
+        tables.append(Table(page=page, row_bounds=row_bounds, column_bounds=column_bounds))
+
+    # top to bottom, then left to right
+    tables.sort(key=lambda t: (t.y0, t.x0))
+    return tables
+
+
+def _page_slices(pages: np.ndarray):
+    order = np.argsort(pages, kind='stable')
+    values, starts = np.unique(pages[order], return_index=True)
+    ends = np.r_[starts[1:], len(order)]
+    return {page: order[start:end] for page, start, end in zip(values.tolist(), starts, ends)}
+
+
+def find_tables(vertical: LineStore, horizontal: LineStore, tolerance: float = SNAP_TOLERANCE,
+                min_columns: int = MIN_COLUMNS) -> List[Table]:
+    # line pages are 0-based (fitz page.number), the tables carry the 1-based page of the span table
+    vertical_pages = _page_slices(vertical.page)
+    horizontal_pages = _page_slices(horizontal.page)
+    tables = []
+    for page in sorted(vertical_pages.keys() & horizontal_pages.keys()):
+        tables += find_page_tables(page + 1, vertical[vertical_pages[page]], horizontal[horizontal_pages[page]],
+                                   tolerance, min_columns)
+    return tables
@@ -0,0 +1,128 @@
+import html
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from table_engine import Table
+
+# a grid is one list of cell texts per table row
+Grid = List[List[str]]
+
+DEFAULT_TABLE_FORMAT = 'ascii'
+
+
+def bin_cells(tables: List[Table], table_ids: np.ndarray, x0: np.ndarray, y0: np.ndarray, x1: np.ndarray,
+              y1: np.ndarray, texts: np.ndarray) -> List[Grid]:
+    # all spans of all tables in one pass: table_ids says which table a span was picked up for,
+    # a span belongs to the row and column its center falls into
+    grids = [[[''] * table.n_columns for _ in range(table.n_rows)] for table in tables]
+    if not tables or len(table_ids) == 0:
+        return grids
+
+    # the span frame stores float32, the centers must not be rounded to it
+    center_x = (np.asarray(x0, dtype=np.float64) + x1) / 2
+    center_y = (np.asarray(y0, dtype=np.float64) + y1) / 2
+
+    # the bounds of all tables concatenated, every table shifted onto its own stretch of the axis
+    # so one binary search over the flat arrays never lands in the bounds of another table
+    row_bounds = [table.row_bounds for table in tables]
+    column_bounds = [table.column_bounds for table in tables]
+    low = min(min(b[0] for b in row_bounds), min(b[0] for b in column_bounds), center_x.min(), center_y.min())
+    high = max(max(b[-1] for b in row_bounds), max(b[-1] for b in column_bounds), center_x.max(), center_y.max())
+    stride = high - low + 1
+    shift = np.arange(len(tables)) * stride - low
+
+    flat_rows = np.concatenate([b + s for b, s in zip(row_bounds, shift)])
+    flat_columns = np.concatenate([b + s for b, s in zip(column_bounds, shift)])
+    row_offsets = np.r_[0, np.cumsum([len(b) for b in row_bounds])]
+    column_offsets = np.r_[0, np.cumsum([len(b) for b in column_bounds])]
+
+    span_shift = shift[table_ids]
+    row = np.searchsorted(flat_rows, center_y + span_shift, side='right') - 1 - row_offsets[table_ids]
+    column = np.searchsorted(flat_columns, center_x + span_shift, side='right') - 1 - column_offsets[table_ids]
+
+    # a center right on the closing line still belongs to the last row / column
+    n_rows = np.array([table.n_rows for table in tables])[table_ids]
+    n_columns = np.array([table.n_columns for table in tables])[table_ids]
+    on_last_row = (row == n_rows) & (center_y + span_shift == flat_rows[row_offsets[table_ids + 1] - 1])
+    on_last_column = (column == n_columns) & (center_x + span_shift == flat_columns[column_offsets[table_ids + 1] - 1])
+    row[on_last_row] -= 1
+    column[on_last_column] -= 1
+
+    # centers outside the grid (picked up through the tolerance margin) are not part of any cell
+    inside = (row >= 0) & (row < n_rows) & (column >= 0) & (column < n_columns)
+    positions = np.flatnonzero(inside)
+    if len(positions) == 0:
+        return grids
+
+    # stable sort keeps the span order inside a cell, one run per cell
+    order = positions[np.lexsort((positions, column[positions], row[positions], table_ids[positions]))]
+    keys = np.column_stack((table_ids[order], row[order], column[order]))
+    starts = np.flatnonzero(np.r_[True, (keys[1:] != keys[:-1]).any(axis=1)])
+    ends = np.r_[starts[1:], len(order)]
+    ordered_texts = texts[order].tolist()
+    for start, end, (t, r, c) in zip(starts.tolist(), ends.tolist(), keys[starts].tolist()):
+        grids[t][r][c] = ' '.join(ordered_texts[start:end])
+    return grids
+
+
+def render_ascii(grid: Grid) -> str:
+    # one width per column over all rows keeps the columns aligned
+    n_columns = len(grid[0]) if grid else 0
+    widths = [max(max(len(row[c]) for row in grid), 1) for c in range(n_columns)]
+    # build borders
+    horizontal_segments = ['─' * (w + 2) for w in widths]
+    top_border = '┌' + '┬'.join(horizontal_segments) + '┐'
+    row_border = '├' + '┼'.join(horizontal_segments) + '┤'
+    bottom_border = '└' + '┴'.join(horizontal_segments) + '┘'
+
+    # build content lines
+    content_lines = [
+        '│' + '│'.join(f" {text.ljust(widths[i])} " for i, text in enumerate(row_cells)) + '│'
+        for row_cells in grid
+    ]
+
+    return '\n'.join([top_border, f'\n{row_border}\n'.join(content_lines), bottom_border])
+
+
+def _markdown_cell(text: str) -> str:
+    return text.replace('|', '\\|').replace('\n', ' ')
+
+
+def render_markdown(grid: Grid) -> str:
+    # the first table row is the header, pdf tables do not mark one
+    n_columns = len(grid[0]) if grid else 0
+    lines = ['| ' + ' | '.join(_markdown_cell(text) for text in row_cells) + ' |' for row_cells in grid]
+    lines.insert(1, '|' + '|'.join(['---'] * n_columns) + '|')
+    return '\n'.join(lines)
+
+
+def render_tsv(grid: Grid) -> str:
+    return '\n'.join('\t'.join(text.replace('\t', ' ') for text in row_cells) for row_cells in grid)
+
+
+def render_html(grid: Grid) -> str:
+    rows = [
+        '<tr>' + ''.join(f'<td>{html.escape(text)}</td>' for text in row_cells) + '</tr>'
+        for row_cells in grid
+    ]
+    return '<table>\n' + '\n'.join(rows) + '\n</table>'
+
+
+TABLE_RENDERERS: Dict[str, Callable[[Grid], str]] = {
+    'ascii': render_ascii,
+    'markdown': render_markdown,
+    'tsv': render_tsv,
+    'html': render_html,
+}
+
+
+def register_renderer(name: str, renderer: Callable[[Grid], str]):
+    TABLE_RENDERERS[name] = renderer
+
+
+def get_renderer(name: str) -> Callable[[Grid], str]:
+    try:
+        return TABLE_RENDERERS[name]
+    except KeyError:
+        raise ValueError(f"unknown table format {name!r}, known: {', '.join(sorted(TABLE_RENDERERS))}") from None
@@ -0,0 +1,81 @@
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+
+from batch_extraction import plan_jobs, run_batch
+from batch_io import IOConfig, LocalFileSystem, SlowFileSystem, WriteBehind
+from benchmark import CorpusSpec, generate_pdf
+
+SPECS = [
+    CorpusSpec("text", pages=2, lines_per_page=30, spans_per_line=3, fonts=3, table_rows_per_page=0, seed=21),
+    CorpusSpec("small", pages=1, lines_per_page=10, spans_per_line=2, fonts=2, table_rows_per_page=0, seed=22),
+    CorpusSpec("table", pages=2, lines_per_page=15, spans_per_line=2, fonts=2, table_rows_per_page=8, seed=23),
+]
+
+
+class BlockingFileSystem(LocalFileSystem):
+    # every write waits until the test lets it through
+    def __init__(self):
+        self.release = threading.Event()
+        self.started = threading.Event()
+
+    def write_bytes(self, path: Path, data: bytes):
+        self.started.set()
+        self.release.wait()
+        super().write_bytes(path, data)
+
+
+class BatchIOTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls._dir = tempfile.TemporaryDirectory()
+        directory = Path(cls._dir.name)
+        cls.paths = []
+        for spec in SPECS:
+            path = directory / f"{spec.name}.pdf"
+            generate_pdf(spec, path)
+            cls.paths.append(path)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._dir.cleanup()
+
+    def _run(self, name: str, io_config=None, stream_min_pages=None) -> dict:
+        output_dir = Path(self._dir.name) / name
+        output_dir.mkdir()
+        jobs = plan_jobs(self.paths, output_dir, stream_min_pages=stream_min_pages)
+        report = run_batch(jobs, max_workers=1, verbose=False, io_config=io_config)
+        self.assertEqual(report.failed, [])
+        return {path.name: path.read_bytes() for path in output_dir.glob('*.txt')}
+
+    def test_slow_filesystem_gives_the_same_outputs(self):
+        plain = self._run('plain')
+        self.assertEqual(len(plain), len(self.paths))
+        slow = IOConfig(filesystem=SlowFileSystem(latency=0.01), read_ahead=2, write_behind=1, write_threads=1)
+        self.assertEqual(self._run('slow', slow), plain)
+        self.assertEqual(self._run('slow_stream', slow, stream_min_pages=2), plain)
+
+    def test_full_write_behind_blocks(self):
+        filesystem = BlockingFileSystem()
+        write_behind = WriteBehind(filesystem, depth=1, threads=1)
+        output = Path(self._dir.name) / 'blocked.txt'
+        write_behind.submit(output, b'first')
+        self.assertTrue(filesystem.started.wait(5))
+
+        second = threading.Thread(target=write_behind.submit, args=(output, b'second'))
+        second.start()
+        second.join(0.2)
+        # the only slot is taken by the first write
+        self.assertTrue(second.is_alive())
+
+        filesystem.release.set()
+        second.join(5)
+        self.assertFalse(second.is_alive())
+        write_behind.close()
+        self.assertEqual(write_behind.errors, {})
+        self.assertEqual(output.read_bytes(), b'second')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,15 @@
+import unittest
+
+from benchmark import check_imports, measure_imports
+
+
+class ImportTest(unittest.TestCase):
+    def test_imports_stay_light(self):
+        # the batch and the workers import these before any document is seen, the frame and validation
+        # libraries are only loaded by documents that need them
+        imports = measure_imports()
+        self.assertEqual(check_imports(imports), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import fitz
+import numpy as np
+import pandas as pd
+
+from benchmark import CorpusSpec, generate_pdf
+from mu_document_utils import DocumentWrapper, process_documents
+
+# small reports like the real corpus, one with drawn tables, plus a document without any text
+SPECS = [
+    CorpusSpec("text", pages=2, lines_per_page=30, spans_per_line=3, fonts=3, table_rows_per_page=0, seed=11),
+    CorpusSpec("fonts", pages=1, lines_per_page=40, spans_per_line=2, fonts=5, table_rows_per_page=0, seed=12),
+    CorpusSpec("table", pages=2, lines_per_page=15, spans_per_line=2, fonts=2, table_rows_per_page=8, seed=13),
+]
+
+
+def _empty_pdf(path: Path):
+    doc = fitz.open()
+    doc.new_page()
+    doc.save(path)
+    doc.close()
+
+
+def _frame_stages(doc: DocumentWrapper, validate: bool = False) -> DocumentWrapper:
+    # the stages one by one, what extract_document did before process_documents
+    has_table = doc.has_table
+    doc.parse_pdf_entries(validate=validate)
+    doc.sanitize_parsed_pdf_entries()
+    if has_table:
+        doc.apply_table_boundaries()
+    doc.collapse_parsed_entries_into_rows(validate=validate)
+    doc.detect_connected_blocks_from_rows()
+    return doc
+
+
+def _reference_block_ids(rows: pd.DataFrame, tolerance: float = 3) -> list:
+    # the old iterrows segmentation: upward jump, or a gap larger than the row height plus the tolerance
+    block_ids = []
+    current_block = 0
+    prev_y0 = None
+    for row in rows.itertuples(index=False):
+        if prev_y0 is None or row.y0 < prev_y0 or abs(float(row.y0) - float(prev_y0)) > row.height + tolerance:
+            current_block += 1
+        block_ids.append(current_block)
+        prev_y0 = row.y0
+    return block_ids
+
+
+class EquivalenceTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls._dir = tempfile.TemporaryDirectory()
+        directory = Path(cls._dir.name)
+        cls.paths = []
+        for spec in SPECS:
+            path = directory / f"{spec.name}.pdf"
+            generate_pdf(spec, path)
+            cls.paths.append(path)
+        _empty_pdf(directory / "empty.pdf")
+        cls.paths.append(directory / "empty.pdf")
+
+    @classmethod
+    def tearDownClass(cls):
+        cls._dir.cleanup()
+
+    def _open(self, path: Path) -> DocumentWrapper:
+        document = fitz.open(path)
+        self.addCleanup(document.close)
+        return DocumentWrapper.from_document(document)
+
+    def test_fast_stages_match_validated(self):
+        for path in self.paths:
+            with self.subTest(path.name):
+                fast = _frame_stages(self._open(path))
+                validated = _frame_stages(self._open(path), validate=True)
+                pd.testing.assert_frame_equal(fast.raw_pdf_content_elements, validated.raw_pdf_content_elements)
+                pd.testing.assert_frame_equal(fast.collapsed_pdf_rows, validated.collapsed_pdf_rows)
+                pd.testing.assert_frame_equal(fast.collapsed_row_spans, validated.collapsed_row_spans)
+                pd.testing.assert_frame_equal(fast.text_blocks, validated.text_blocks)
+
+    def test_blocks_match_reference_segmentation(self):
+        for path in self.paths[:2]:
+            with self.subTest(path.name):
+                rows = _frame_stages(self._open(path)).collapsed_pdf_rows
+                self.assertEqual(rows['block_id'].tolist(), _reference_block_ids(rows))
+
+    def test_batch_matches_per_document(self):
+        single = [_frame_stages(self._open(path)) for path in self.paths]
+        batched = [self._open(path) for path in self.paths]
+        process_documents(batched)
+        for path, a, b in zip(self.paths, single, batched):
+            with self.subTest(path.name):
+                self.assertEqual(a.blocks_text(), b.blocks_text())
+                records_a, records_b = a.block_records(), b.block_records()
+                for column in records_a:
+                    self.assertEqual(records_a[column].dtype, records_b[column].dtype)
+                    np.testing.assert_array_equal(records_a[column], records_b[column])
+
+    def test_tables_are_blocks_of_their_own(self):
+        doc = self._open(self.paths[2])
+        process_documents([doc])
+        records = doc.block_records()
+        self.assertEqual(int(records['table'].sum()), len(doc.tables))
+        for text in records['text'][records['table']]:
+            self.assertTrue(text.startswith('┌'), text[:80])
+
+
+if __name__ == '__main__':
+    unittest.main()